@@ -1,16 +1,35 @@
 # main.py
-import src.master_script_generator as script_gen
-import src.audio_generator_gemini as audio_gen
-import src.image_generator as image_gen
-import src.video_assembler as video_assembler
+import os
+import sys
+
+# The stage modules import their siblings (and src/config.py) as top-level modules; putting
+# src first also keeps `import config` from resolving to the repo's config/ data folder.
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')
+sys.path.insert(0, SRC_DIR)
+
+# --- Pipeline stages to run (all off, as before) ---
+RUN_SCRIPT_STAGE = False
+RUN_AUDIO_STAGE = False
+RUN_IMAGE_STAGE = False
+RUN_VIDEO_STAGE = False
 
 def run_ffmpeg_pipeline():
+    # Each stage imports its module only when it actually runs, so starting the CLI
+    # doesn't pay for every SDK import up front (google-genai alone is slow to import).
     print("--- STARTING FFMPEG PIPELINE ---")
-    # script_gen.main()
-    # audio_gen.main()
-    # image_gen.main()
-    # video_assembler.main()
+    if RUN_SCRIPT_STAGE:
+        import master_script_generator as script_gen
+        script_gen.main()
+    if RUN_AUDIO_STAGE:
+        import audio_generator_gemini as audio_gen
+        audio_gen.main()
+    if RUN_IMAGE_STAGE:
+        import image_generator as image_gen
+        image_gen.main([])
+    if RUN_VIDEO_STAGE:
+        import video_assembler as video_assembler
+        video_assembler.main()
     print("--- FFMPEG PIPELINE COMPLETE ---")
 
 if __name__ == "__main__":
-    run_ffmpeg_pipeline()
\ No newline at end of file
+    run_ffmpeg_pipeline()
@@ -0,0 +1,220 @@
+"""Helpers for calling the remote generation APIs (retries, rate limiting, failure bookkeeping)."""
+import os
+import json
+import time
+import random
+import datetime
+import asyncio
+import importlib.util
+
+# HTTP status codes worth retrying: timeouts, rate limits and server-side errors
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+_TRANSIENT_MARKERS = ('resource_exhausted', 'quota', 'rate limit', 'too many requests', 'unavailable', 'deadline_exceeded')
+
+def is_transient_error(error):
+    """Returns True for errors that are likely to succeed on retry (429s, 5xx, timeouts, dropped connections)."""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    # ElevenLabs' ApiError exposes `status_code`, google-genai's APIError exposes `code`
+    for attr in ('status_code', 'code'):
+        status = getattr(error, attr, None)
+        if isinstance(status, int) and status in TRANSIENT_STATUS_CODES:
+            return True
+    message = str(error).lower()
+    return any(marker in message for marker in _TRANSIENT_MARKERS)
+
+def backoff_delay(attempt, initial_delay=1, max_delay=30):
+    """Exponential backoff with jitter: roughly 1s, 2s, 4s, ... capped at `max_delay`."""
+    return min(max_delay, initial_delay * 2 ** attempt + random.uniform(0, initial_delay))
+
+def call_with_retry(fn, *args, attempts=5, initial_delay=1, max_delay=30, label="request", **kwargs):
+    """Calls `fn(*args, **kwargs)`, retrying transient errors with exponential backoff. Re-raises the final error."""
+    for attempt in range(attempts):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == attempts - 1 or not is_transient_error(e):
+                raise
+            delay = backoff_delay(attempt, initial_delay, max_delay)
+            print(f"    >> Transient error on {label} ({e}). Retrying in {delay:.1f}s (attempt {attempt + 2}/{attempts})...")
+            time.sleep(delay)
+
+async def async_call_with_retry(fn, *args, attempts=5, initial_delay=1, max_delay=30, label="request", **kwargs):
+    """Async version of call_with_retry: awaits `fn(*args, **kwargs)` and sleeps without blocking the event loop."""
+    for attempt in range(attempts):
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == attempts - 1 or not is_transient_error(e):
+                raise
+            delay = backoff_delay(attempt, initial_delay, max_delay)
+            print(f"    >> Transient error on {label} ({e}). Retrying in {delay:.1f}s (attempt {attempt + 2}/{attempts})...")
+            await asyncio.sleep(delay)
+
+def fast_text(response):
+    """
+    Returns the text of a single-part Gemini response straight from the first candidate,
+    skipping the `response.text` property's part concatenation and checks. Falls back to
+    `response.text` (which also raises the usual errors for blocked responses) otherwise.
+    """
+    try:
+        parts = response.candidates[0].content.parts
+        if len(parts) == 1 and parts[0].text is not None:
+            return parts[0].text
+    except (IndexError, AttributeError, TypeError):
+        pass
+    return response.text
+
+# Connections kept open to the Gemini/Imagen endpoints; sized above the request concurrency
+MAX_CONNECTIONS = 32
+
+def make_genai_client(api_key):
+    """
+    Creates a google-genai Client whose sync and async HTTP transports keep a pool of
+    warm keep-alive connections, so concurrent requests skip the TCP+TLS handshake.
+    HTTP/2 multiplexing is switched on when the optional `h2` package is installed.
+    """
+    # Imported here so the ElevenLabs-only generator doesn't pay for the Google SDK
+    import httpx
+    from google import genai
+    from google.genai import types
+
+    limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)
+    transport_args = {'limits': limits, 'http2': importlib.util.find_spec('h2') is not None}
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(client_args=transport_args, async_client_args=transport_args),
+    )
+
+# How long a book stays cached on Gemini's side; one pipeline run fits comfortably
+BOOK_CACHE_TTL = datetime.timedelta(hours=1)
+
+def create_book_cache(book_text, model_name, book_title, ttl=BOOK_CACHE_TTL):
+    """
+    Uploads the book once as a Gemini cached context (google.generativeai) so every
+    request can reference it instead of re-sending the full text. Returns None
+    (callers then inline the text) if the cache can't be created, e.g. when the book
+    is below the model's minimum cacheable size. Callers delete it when done.
+    """
+    import google.generativeai as genai
+
+    try:
+        cache = genai.caching.CachedContent.create(
+            model=f'models/{model_name}',
+            display_name=f'{book_title} book text',
+            contents=[book_text],
+            ttl=ttl,
+        )
+        print(f"✓ Book text cached on Gemini ({cache.name}).")
+        return cache
+    except Exception as e:
+        print(f"  > Warning: Could not create a context cache, sending the book text inline instead: {e}")
+        return None
+
+def delete_book_cache(cache):
+    if cache:
+        try:
+            cache.delete()
+        except Exception as e:
+            print(f"Warning: Could not delete the context cache: {e}")
+
+# Batch jobs may sit in the queue for hours and expire after 48h, so a cache they reference must
+# outlive that window rather than the one-hour BOOK_CACHE_TTL
+BATCH_CACHE_TTL = datetime.timedelta(hours=48)
+
+def extend_book_cache(cache, ttl=BATCH_CACHE_TTL):
+    """
+    Pushes a book cache's expiry out to `ttl` from now, before submitting a batch job that
+    references it. Returns False if the update fails; callers then send the book inline.
+    """
+    try:
+        cache.update(ttl=ttl)
+        print(f"✓ Book cache kept alive for {ttl} to cover the batch job.")
+        return True
+    except Exception as e:
+        print(f"  > Warning: Could not extend the context cache, sending the book text inline instead: {e}")
+        return False
+
+BATCH_POLL_SECONDS = 30
+BATCH_DONE_STATES = {'JOB_STATE_SUCCEEDED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'}
+
+async def run_batch_job(api_key, model_name, prompts, display_name, cached_content=None, poll_seconds=BATCH_POLL_SECONDS):
+    """
+    Submits `prompts` as ONE Gemini Batch API job of inline requests and polls until it finishes.
+    Returns the response texts in prompt order (None for requests that failed).
+    Batch jobs are billed at a discount and aren't subject to the per-minute request quota,
+    but can take minutes to hours to complete.
+    """
+    # The Batch API lives in the newer google-genai SDK, which make_genai_client imports on demand
+    client = make_genai_client(api_key)
+    inlined_requests = []
+    for prompt in prompts:
+        request = {'contents': [{'parts': [{'text': prompt}], 'role': 'user'}]}
+        if cached_content:
+            request['config'] = {'cached_content': cached_content}
+        inlined_requests.append(request)
+
+    job = await client.aio.batches.create(
+        model=f'models/{model_name}',
+        src=inlined_requests,
+        config={'display_name': display_name},
+    )
+    print(f"  > Submitted batch job {job.name} with {len(prompts)} requests. Polling every {poll_seconds}s...")
+
+    while job.state.name not in BATCH_DONE_STATES:
+        await asyncio.sleep(poll_seconds)
+        job = await client.aio.batches.get(name=job.name)
+        print(f"    >> Batch job state: {job.state.name}")
+
+    if job.state.name != 'JOB_STATE_SUCCEEDED':
+        print(f"  > Batch job ended in state {job.state.name}: {job.error}")
+        return [None] * len(prompts)
+
+    # Inline responses come back in request order, so the index is the correlation id
+    results = []
+    for inline_response in job.dest.inlined_responses:
+        text = fast_text(inline_response.response) if inline_response.response else None
+        results.append(text.strip() if text and text.strip() else None)
+    return results
+
+def record_failures(output_dir, failed_parts):
+    """
+    Writes the failed part numbers to `failed.json` in `output_dir` so the next run knows
+    what is left to retry, or removes a stale sidecar when everything succeeded.
+    """
+    sidecar_path = os.path.join(output_dir, 'failed.json')
+    if failed_parts:
+        with open(sidecar_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({"failed_parts": sorted(failed_parts)}))
+        print(f"Recorded {len(failed_parts)} failed part(s) in {sidecar_path}. Re-run to retry them.")
+    elif os.path.exists(sidecar_path):
+        os.remove(sidecar_path)
+
+class AsyncRateLimiter:
+    """
+    Token bucket limiting calls to `max_rate` per `time_period` seconds. Use it as
+    `async with limiter:` around each API call: bursts up to `max_rate` go through
+    immediately, after that callers are paced without blocking the event loop.
+    """
+
+    def __init__(self, max_rate, time_period=60):
+        self.max_rate = max_rate
+        self.refill_per_second = max_rate / time_period
+        self._tokens = float(max_rate)
+        self._last = time.monotonic()
+
+    async def acquire(self):
+        now = time.monotonic()
+        self._tokens = min(self.max_rate, self._tokens + (now - self._last) * self.refill_per_second)
+        self._last = now
+        # Reserve a token up front; a negative balance is the wait until our turn comes
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.refill_per_second)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
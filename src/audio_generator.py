@@ -1,77 +1,102 @@
 import os
-import json
+import threading
+from dataclasses import dataclass
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from elevenlabs.client import ElevenLabs
-from elevenlabs import save
-
-# --- Helper Functions (No changes here) ---
-
-def load_elevenlabs_api_key():
-    """Loads the ElevenLabs API key from the config file."""
-    try:
-        with open('../config/api_keys.json', 'r') as f:
-            keys = json.load(f)
-            return keys.get('elevenlabs_api_key')
-    except Exception as e:
-        print(f"Error loading API key: {e}")
-        return None
-
-def read_master_script(book_title, script_filename):
-    """Reads the content of the master script file."""
-    script_path = os.path.join('..', 'books', book_title, 'scripts', script_filename)
-    try:
-        with open(script_path, 'r', encoding='utf-8') as f:
-            print(f"Successfully read master script from {script_path}")
-            return f.read()
-    except FileNotFoundError:
-        print(f"Error: Master script file not found at {script_path}")
-        return None
-
-def split_script(text, max_chars=30000):
-    """Splits the script into chunks under the character limit."""
-    chunks = []
-    current_pos = 0
-    while current_pos < len(text):
-        end_pos = min(current_pos + max_chars, len(text))
-        if end_pos < len(text):
-            split_point = text.rfind('\n\n', current_pos, end_pos)
-            if split_point != -1:
-                end_pos = split_point
-        chunk = text[current_pos:end_pos].strip()
-        if chunk:
-            chunks.append(chunk)
-        current_pos = end_pos
-    print(f"Script split into {len(chunks)} chunks for audio generation.")
-    return chunks
+from text_utils import load_api_key, read_master_script, split_script
+from api_utils import call_with_retry, record_failures
 
 # --- Main Audio Generation Logic (Corrected) ---
 
-def generate_audio_for_chunks(client, script_chunks, book_title):
-    """Loops through script chunks and generates an audio file for each."""
+@dataclass(frozen=True, slots=True)
+class TTSParams:
+    """Fixed ElevenLabs request parameters, built once at import time."""
+    voice_id: str
+    model: str
+    output_format: str = "mp3_44100_128"
+    optimize_streaming_latency: Optional[int] = None
+
+# The Voice ID for "Adam"
+ADAM_VOICE_ID = "AeRdCCKzvd23BpJoofzx"
+
+# Much lower latency, good for drafts
+FAST_TTS = TTSParams(voice_id=ADAM_VOICE_ID, model="eleven_turbo_v2_5", optimize_streaming_latency=3)
+# Best quality, use for final renders
+HIGH_QUALITY_TTS = TTSParams(voice_id=ADAM_VOICE_ID, model="eleven_multilingual_v2")
+
+# Set to True for final renders: uses eleven_multilingual_v2 instead of the low-latency turbo model
+HIGH_QUALITY = False
+
+def generate_audio_for_chunks(client, script_chunks, book_title, max_workers=8, max_concurrent_requests=4,
+                              high_quality=HIGH_QUALITY):
+    """
+    Generates an audio file for each script chunk, rendering several chunks in parallel.
+
+    `max_workers` sizes the thread pool, while `max_concurrent_requests` caps how many
+    requests are in flight at once so we stay under the ElevenLabs plan's concurrency
+    limit (exceeding it returns 429s). `high_quality` selects the slower multilingual
+    model instead of the turbo one.
+    """
     audio_dir = os.path.join('..', 'books', book_title, 'audio')
     os.makedirs(audio_dir, exist_ok=True)
-    
-    # The Voice ID for "Adam"
-    ADAM_VOICE_ID = "AeRdCCKzvd23BpJoofzx"
 
-    for i, chunk in enumerate(script_chunks):
-        file_path = os.path.join(audio_dir, f"audio_part_{i+1}.mp3")
-        print(f"\nGenerating audio for chunk {i+1}/{len(script_chunks)}...")
-        
-        try:
-            # --- THIS IS THE CORRECTED METHOD CALL BASED ON YOUR DOCUMENTATION ---
-            audio_stream = client.text_to_speech.convert(
-                voice_id=ADAM_VOICE_ID,
-                model_id="eleven_multilingual_v2", # This model is good for narration
-                text=chunk
+    params = HIGH_QUALITY_TTS if high_quality else FAST_TTS
+    request_slots = threading.Semaphore(max_concurrent_requests)
+
+    def _request_and_save(chunk, file_path):
+        with request_slots:
+            # The streaming endpoint starts sending audio as soon as the first bytes are synthesized
+            audio_stream = client.text_to_speech.stream(
+                voice_id=params.voice_id,
+                model_id=params.model,
+                text=chunk,
+                optimize_streaming_latency=params.optimize_streaming_latency,
+                output_format=params.output_format
             )
 
-            # The save function is designed to handle the audio stream
-            save(audio_stream, file_path)
-            
-            print(f"--> Successfully saved chunk {i+1} to {file_path}")
-        except Exception as e:
-            print(f"--> Error generating audio for chunk {i+1}: {e}")
-            break
+            # Write the audio bytes to disk as they arrive instead of buffering the whole file.
+            # The temp name means an interrupted download never looks like a finished part.
+            temp_path = file_path + '.part'
+            with open(temp_path, 'wb') as f:
+                for audio_bytes in audio_stream:
+                    if audio_bytes:
+                        f.write(audio_bytes)
+            os.replace(temp_path, file_path)
+
+    def _render(i, chunk, file_path):
+        print(f"\nGenerating audio for chunk {i+1}/{len(script_chunks)}...")
+        # Rate limits (429) and server errors are retried with backoff; the request slot is
+        # released between attempts so other chunks can use it.
+        call_with_retry(_request_and_save, chunk, file_path, label=f"chunk {i+1}")
+        return file_path
+
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for i, chunk in enumerate(script_chunks):
+            file_path = os.path.join(audio_dir, f"audio_part_{i+1}.mp3")
+            # Skip parts that were already rendered (zero-byte files are leftovers from a crash)
+            if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+                print(f"Audio for chunk {i+1} already exists. Skipping.")
+                continue
+            futures[executor.submit(_render, i, chunk, file_path)] = i
+
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                file_path = future.result()
+                print(f"--> Successfully saved chunk {i+1} to {file_path}")
+            except Exception as e:
+                # Keep going: one failed chunk should not abort the others
+                print(f"--> Error generating audio for chunk {i+1}: {e}")
+                errors[i + 1] = e
+
+    print(f"\nAudio generation summary: {len(script_chunks) - len(errors)}/{len(script_chunks)} chunks succeeded.")
+    if errors:
+        print(f"Failed chunks: {', '.join(str(n) for n in sorted(errors))}")
+    record_failures(audio_dir, list(errors))
+    return errors
 
 # --- Main Execution (No changes here, TEST_MODE is still active) ---
 
@@ -87,7 +112,7 @@ if __name__ == "__main__":
     if TEST_MODE:
         print("--- RUNNING IN TEST MODE ---")
 
-    api_key = load_elevenlabs_api_key()
+    api_key = load_api_key('elevenlabs')
     if api_key:
         elevenlabs_client = ElevenLabs(api_key=api_key)
         master_script_text = read_master_script(BOOK_TITLE, SCRIPT_FILENAME)
@@ -1,98 +1,80 @@
 # src/audio_generator_gemini.py (Final Corrected Version)
 import os
-import json
-import glob
-import google.genai as genai
+import asyncio
 from google.genai import types
-import wave
-from natsort import natsorted
+import struct
+from pathlib import Path
+from dataclasses import dataclass
+from path_utils import CHUNK_FILE_RE, prefetch_files, scan_files, sorted_by_part
 import config
-
-# --- Helper function from the documentation to save WAV files ---
+from text_utils import load_api_key
+from api_utils import async_call_with_retry, call_with_retry, make_genai_client, record_failures
+
+@dataclass(frozen=True, slots=True)
+class TTSParams:
+    """Fixed Gemini TTS request parameters, built once at import time."""
+    voice_name: str
+    model: str
+    prompt_prefix: str
+
+GEMINI_TTS = TTSParams(
+    voice_name='Algieba',
+    model="gemini-2.5-pro-preview-tts",
+    prompt_prefix="Read in a calm, gentle audiobook narration: "
+)
+
+# The TTS request config is the same for every chunk, so build (and validate) it once
+TTS_CONFIG = types.GenerateContentConfig(
+    response_modalities=["AUDIO"],
+    speech_config=types.SpeechConfig(
+        voice_config=types.VoiceConfig(
+            prebuilt_voice_config=types.PrebuiltVoiceConfig(voice_name=GEMINI_TTS.voice_name)
+        )
+    )
+)
+
+# Canonical 44-byte PCM WAV header: RIFF chunk, 'fmt ' sub-chunk, then the 'data' sub-chunk header
+WAV_HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')
+
+# --- Helper function to save WAV files ---
 def save_wav_file(filename, pcm_data, channels=1, sample_width=2, framerate=24000):
-    """Saves PCM audio data to a WAV file."""
+    """Saves PCM audio data to a WAV file, writing the header directly instead of going through the wave module."""
     try:
-        with wave.open(filename, "wb") as wf:
-            wf.setnchannels(channels)
-            wf.setsampwidth(sample_width)
-            wf.setframerate(framerate)
-            wf.writeframes(pcm_data)
+        data_len = len(pcm_data)
+        header = WAV_HEADER.pack(
+            b'RIFF', 36 + data_len, b'WAVE',
+            b'fmt ', 16, 1, channels, framerate,
+            framerate * channels * sample_width, channels * sample_width, sample_width * 8,
+            b'data', data_len
+        )
+        with open(filename, "wb") as f:
+            f.write(header)
+            f.write(pcm_data)
         return True
     except Exception as e:
         print(f"  > Error saving WAV file: {e}")
         return False
 
-# --- Helper functions from our previous scripts ---
-def load_api_key():
-    """Loads the Google API key from the config file."""
-    try:
-        with open('../config/api_keys.json', 'r') as f:
-            keys = json.load(f)
-            return keys.get('google_api_key')
-    except Exception as e:
-        print(f"Error loading API key: {e}")
-        return None
-
-def read_master_script(book_title, script_filename):
-    """Reads the content of the master script file."""
-    script_path = os.path.join('..', 'books', book_title, 'scripts', script_filename)
-    try:
-        with open(script_path, 'r', encoding='utf-8') as f:
-            print(f"Successfully read master script from {script_path}")
-            return f.read()
-    except FileNotFoundError:
-        print(f"Error: Master script file not found at {script_path}")
-        return None
-
-def split_script(text, max_chars=4000):
-    """
-    Splits the script into chunks safely under the Gemini API character limit for TTS.
-    """
-    chunks = []
-    current_pos = 0
-    while current_pos < len(text):
-        end_pos = min(current_pos + max_chars, len(text))
-        if end_pos < len(text):
-            split_point = text.rfind('\n\n', current_pos, end_pos)
-            if split_point != -1:
-                end_pos = split_point
-        
-        chunk = text[current_pos:end_pos].strip()
-        if chunk:
-            chunks.append(chunk)
-        current_pos = end_pos
-    
-    print(f"Script split into {len(chunks)} chunks for audio generation.")
-    return chunks
-
 # --- Main Audio Generation Logic using Gemini TTS ---
 def generate_audio_for_chunks(client, script_chunks, book_title):
     """Loops through script chunks and generates a WAV audio file for each."""
     audio_dir = os.path.join('..', 'books', book_title, 'audio')
     os.makedirs(audio_dir, exist_ok=True)
-    
+
+    failed_parts = []
     for i, chunk in enumerate(script_chunks):
         file_path = os.path.join(audio_dir, f"audio_part_{i+1}.wav")
         print(f"\nGenerating audio for chunk {i+1}/{len(script_chunks)}...")
         
         try:
-            prompt_text = f"Say in a calm, gentle audiobook narration: {chunk}"
-            
-            tts_config = types.GenerateContentConfig(
-                response_modalities=["AUDIO"],
-                speech_config=types.SpeechConfig(
-                    voice_config=types.VoiceConfig(
-                        prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                            voice_name='Algieba'
-                        )
-                    )
-                )
-            )
+            prompt_text = GEMINI_TTS.prompt_prefix + chunk
 
-            response = client.models.generate_content(
-                model="models/gemini-2.5-pro-preview-tts",
+            response = call_with_retry(
+                client.models.generate_content,
+                model=GEMINI_TTS.model,
                 contents=[prompt_text],
-                config=tts_config
+                config=TTS_CONFIG,
+                label=f"chunk {i+1}"
             )
 
             # --- NEW, ROBUST ERROR CHECKING ---
@@ -102,82 +84,150 @@ def generate_audio_for_chunks(client, script_chunks, book_title):
                 if response.prompt_feedback and response.prompt_feedback.block_reason:
                     reason = response.prompt_feedback.block_reason
                 print(f"--> WARNING: Chunk {i+1} was blocked by API safety filters (Reason: {reason}). Skipping.")
+                failed_parts.append(i + 1)
                 continue # Move to the next chunk
 
             # If not blocked, proceed to get the audio data
             audio_data = response.candidates[0].content.parts[0].inline_data.data
             if save_wav_file(file_path, audio_data):
                 print(f"--> Successfully saved chunk {i+1} to {file_path}")
+            else:
+                failed_parts.append(i + 1)
 
         except Exception as e:
             print(f"--> Error generating audio for chunk {i+1}: {e}")
+            failed_parts.append(i + 1)
             continue # Continue to the next chunk even if there's an error
 
-# --- Main Execution ---
-if __name__ == "__main__":
+    record_failures(audio_dir, failed_parts)
+
+# --- Concurrent Audio Generation for Chunk Files ---
+def _audio_path_for_chunk(chunk_path):
+    """Maps chunk_NN.txt to its part number string and audio_part_NN.wav output path."""
+    part_num_str = os.path.basename(chunk_path).replace('chunk_', '').replace('.txt', '')
+    return part_num_str, os.path.join(config.AUDIO_DIR, f"audio_part_{part_num_str}.wav")
+
+async def render_chunk(client, chunk_path, total_parts, sem):
+    """
+    Generates the WAV file for a single chunk file, holding a semaphore slot while the request
+    is in flight. Returns the audio path, or None if the chunk could not be rendered.
+    """
+    part_num_str, audio_path = _audio_path_for_chunk(chunk_path)
+
+    # Skip if the audio file already exists (checked before taking a slot)
+    if os.path.exists(audio_path):
+        print(f"  > Part {part_num_str}/{total_parts}: audio file already exists. Skipping.")
+        return audio_path
+
+    try:
+        # Read off the event loop so other parts' requests keep flowing
+        text_to_speak = await asyncio.to_thread(Path(chunk_path).read_text, encoding='utf-8')
+        prompt_text = GEMINI_TTS.prompt_prefix + text_to_speak
+
+        async def _request():
+            async with sem:
+                print(f"\n--- Processing Part {part_num_str}/{total_parts} ---")
+                return await client.aio.models.generate_content(
+                    model=GEMINI_TTS.model, contents=[prompt_text], config=TTS_CONFIG
+                )
+
+        # Transient errors (429/5xx) are retried with backoff, releasing the slot while waiting
+        response = await async_call_with_retry(_request, label=f"part {part_num_str}")
+
+        if not response.candidates:
+            reason = response.prompt_feedback.block_reason if response.prompt_feedback else "Unknown"
+            print(f"--> WARNING: Chunk {part_num_str} was blocked by API (Reason: {reason}). Skipping.")
+            return None
+
+        audio_data = response.candidates[0].content.parts[0].inline_data.data
+        if save_wav_file(audio_path, audio_data):
+            print(f"--> Successfully saved audio for part {part_num_str}")
+            return audio_path
+
+    except Exception as e:
+        print(f"--> Error generating audio for chunk {part_num_str}: {e}")
+    return None
+
+async def stream_audio_files(client, chunk_files, max_concurrent=8):
+    """
+    Generates audio for all chunk files concurrently and yields the WAV paths in part order
+    as soon as each part (and every part before it) is ready, so a downstream stage can
+    start on part 1 while later parts are still being synthesized. Failed parts are skipped.
+    """
+    sem = asyncio.Semaphore(max_concurrent)
+    total_parts = len(chunk_files)
+
+    # Warm the page cache for all chunk files while the first requests are in flight
+    prefetch_files(chunk_files)
+
+    async def _render(index, chunk_path):
+        return index, await render_chunk(client, chunk_path, total_parts, sem)
+
+    tasks = [asyncio.ensure_future(_render(i, chunk_path)) for i, chunk_path in enumerate(chunk_files)]
+
+    # Completed parts wait in `ready` until every earlier part has been yielded
+    ready = {}
+    next_expected = 0
+    try:
+        for finished in asyncio.as_completed(tasks):
+            index, path = await finished
+            ready[index] = path
+            while next_expected in ready:
+                audio_path = ready.pop(next_expected)
+                next_expected += 1
+                if audio_path:
+                    yield audio_path
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def generate_all_audio(client, chunk_files, max_concurrent=8):
+    """
+    Fans out TTS requests for all chunk files, with at most `max_concurrent` in flight.
+    Returns the paths of the audio files that are ready, in part order.
+    """
+    audio_paths = []
+    async for audio_path in stream_audio_files(client, chunk_files, max_concurrent):
+        print(f"  > Ready for assembly: {os.path.basename(audio_path)}")
+        audio_paths.append(audio_path)
+
+    done = set(audio_paths)
+    failed_parts = []
+    for chunk_path in chunk_files:
+        part_num_str, audio_path = _audio_path_for_chunk(chunk_path)
+        if audio_path not in done:
+            failed_parts.append(part_num_str)
+    record_failures(config.AUDIO_DIR, failed_parts)
+    return audio_paths
+
+def main():
     print("--- Starting Audio Generation with Gemini TTS ---")
 
     # 1. Load the API key
-    api_key = load_api_key()
+    api_key = load_api_key('google')
     if not api_key:
         print("--- Halting: Could not load Google API key. ---")
-    else:
-        gemini_client = genai.Client(api_key=api_key)
-        
-        # 2. Find all the chunk files created by the master script generator
-        chunk_files = natsorted(glob.glob(os.path.join(config.CHUNKS_DIR, 'chunk_*.txt')))
-
-        if not chunk_files:
-            print(f"FATAL ERROR: No chunk files found in {config.CHUNKS_DIR}")
-            print("Please run master_script_generator.py first.")
-        else:
-            os.makedirs(config.AUDIO_DIR, exist_ok=True)
-            print(f"Found {len(chunk_files)} text chunks. Starting audio generation for '{config.BOOK_TITLE}'.")
-
-            # 3. Loop through each chunk file
-            for chunk_path in chunk_files:
-                # Determine the correct output file name from the chunk name
-                part_num_str = os.path.basename(chunk_path).replace('chunk_', '').replace('.txt', '')
-                audio_path = os.path.join(config.AUDIO_DIR, f"audio_part_{part_num_str}.wav")
-                
-                print(f"\n--- Processing Part {part_num_str}/{len(chunk_files)} ---")
-
-                # 4. Skip if the audio file already exists
-                if os.path.exists(audio_path):
-                    print(f"  > Audio file already exists. Skipping.")
-                    continue
-
-                # 5. Read the text from the chunk file
-                with open(chunk_path, 'r', encoding='utf-8') as f:
-                    text_to_speak = f.read()
-
-                # 6. Generate audio for that chunk
-                try:
-                    prompt_text = f"Read in a calm, gentle audiobook narration: {text_to_speak}"
-                    
-                    tts_config = types.GenerateContentConfig(
-                        response_modalities=["AUDIO"],
-                        speech_config=types.SpeechConfig(
-                            voice_config=types.VoiceConfig(
-                                prebuilt_voice_config=types.PrebuiltVoiceConfig(voice_name='Algieba')
-                            )
-                        )
-                    )
-
-                    response = gemini_client.models.generate_content(
-                        model="gemini-2.5-pro-preview-tts", contents=[prompt_text], config=tts_config
-                    )
-
-                    if not response.candidates:
-                        reason = response.prompt_feedback.block_reason if response.prompt_feedback else "Unknown"
-                        print(f"--> WARNING: Chunk was blocked by API (Reason: {reason}). Skipping.")
-                        continue
-
-                    audio_data = response.candidates[0].content.parts[0].inline_data.data
-                    if save_wav_file(audio_path, audio_data):
-                        print(f"--> Successfully saved audio for part {part_num_str}")
-
-                except Exception as e:
-                    print(f"--> Error generating audio for chunk {part_num_str}: {e}")
-            
-            print("\n--- Audio generation process complete! ---")
\ No newline at end of file
+        return
+
+    gemini_client = make_genai_client(api_key)
+
+    # 2. Find all the chunk files created by the master script generator
+    # (one os.scandir pass; a missing directory simply yields no chunks)
+    chunk_files = sorted_by_part(scan_files(config.CHUNKS_DIR, CHUNK_FILE_RE))
+
+    if not chunk_files:
+        print(f"FATAL ERROR: No chunk files found in {config.CHUNKS_DIR}")
+        print("Please run master_script_generator.py first.")
+        return
+
+    os.makedirs(config.AUDIO_DIR, exist_ok=True)
+    print(f"Found {len(chunk_files)} text chunks. Starting audio generation for '{config.BOOK_TITLE}'.")
+
+    # 3. Generate audio for all chunks concurrently
+    asyncio.run(generate_all_audio(gemini_client, chunk_files))
+
+    print("\n--- Audio generation process complete! ---")
+
+# --- Main Execution ---
+if __name__ == "__main__":
+    main()
@@ -13,10 +13,13 @@ BOOK_DIR = os.path.join(BASE_DIR, 'books', BOOK_TITLE)
 CONFIG_DIR = os.path.join(BASE_DIR, 'config')
 MUSIC_DIR = os.path.join(BASE_DIR, 'music')
 OVERLAYS_DIR = os.path.join(BASE_DIR, 'overlays')
+CACHE_DIR = os.path.join(BASE_DIR, 'cache') # Shared across books, safe to delete
+IMAGES_CACHE_DIR = os.path.join(CACHE_DIR, 'images')
 
 # --- Book-Specific Directories ---
 CHUNKS_DIR = os.path.join(BOOK_DIR, 'chunks') # Our new "source of truth"
 AUDIO_DIR = os.path.join(BOOK_DIR, 'audio')
 IMAGES_DIR = os.path.join(BOOK_DIR, 'images')
 VIDEO_DIR = os.path.join(BOOK_DIR, 'video')
-TEMP_DIR = os.path.join(VIDEO_DIR, 'temp_files')
\ No newline at end of file
+TEMP_DIR = os.path.join(VIDEO_DIR, 'temp_files')
+BOOK_CACHE_DIR = os.path.join(CACHE_DIR, BOOK_TITLE) # Derived data that is safe to delete
\ No newline at end of file
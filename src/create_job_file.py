@@ -1,8 +1,8 @@
 import os
 import json
-import glob
+import re
 import random  # <-- Added the 'random' library
-from natsort import natsorted
+from path_utils import group_images_by_part, scan_files, sorted_by_part
 
 # --- Configuration ---
 BOOK_TITLE = "Meditations by Marcus Aurelius"
@@ -11,6 +11,8 @@ AUDIO_DIR = os.path.join(BASE_DIR, 'audio')
 IMAGES_DIR = os.path.join(BASE_DIR, 'images')
 OVERLAYS_DIR = os.path.join('..', 'overlays')
 
+AUDIO_FILE_RE = re.compile(r'audio_part_(\d+)\.mp3')
+
 def create_job_file():
     """
     Scans for all generated assets and creates a structured JSON file
@@ -23,16 +25,23 @@ def create_job_file():
         "assets": []
     }
 
-    audio_files = natsorted(glob.glob(os.path.join(AUDIO_DIR, 'audio_part_*.mp3')))
-    
+    # Resolve the directory roots once; scanning an absolute directory yields absolute
+    # file paths, so no per-file os.path.abspath (and getcwd) call is needed below.
+    audio_dir = os.path.abspath(AUDIO_DIR)
+    images_dir = os.path.abspath(IMAGES_DIR)
+    overlays_dir = os.path.abspath(OVERLAYS_DIR)
+
+    audio_files = sorted_by_part(scan_files(audio_dir, AUDIO_FILE_RE))
+    images_by_part = group_images_by_part(images_dir)
+
     # --- UPDATED LOGIC TO SELECT A RANDOM OVERLAY ---
-    overlay_files = glob.glob(os.path.join(OVERLAYS_DIR, '*.*'))
+    overlay_files = [path for path in scan_files(overlays_dir) if '.' in os.path.basename(path)]
     default_overlay_path = "" # Default empty value
 
     if overlay_files:
         # If any overlay files are found, pick one at random
         chosen_overlay = random.choice(overlay_files)
-        default_overlay_path = os.path.abspath(chosen_overlay)
+        default_overlay_path = chosen_overlay
         print(f"Randomly selected overlay: {os.path.basename(chosen_overlay)}")
     else:
         print("Warning: No overlay files found in the /overlays folder.")
@@ -47,7 +56,7 @@ def create_job_file():
     for i, audio_path in enumerate(audio_files):
         part_num = i + 1
         
-        images = natsorted(glob.glob(os.path.join(IMAGES_DIR, f'image_part_{part_num}_img_*.png')))
+        images = sorted_by_part(images_by_part[part_num])
         
         if not images:
             print(f"Warning: No images found for part {part_num}. This part will be skipped.")
@@ -55,15 +64,16 @@ def create_job_file():
 
         part_asset = {
             "part": part_num,
-            "audio_path": os.path.abspath(audio_path),
-            "image_paths": [os.path.abspath(img) for img in images],
+            "audio_path": audio_path,
+            "image_paths": images,
             "overlay_path": default_overlay_path
         }
         job_data["assets"].append(part_asset)
 
     output_path = os.path.join(BASE_DIR, 'job.json')
-    with open(output_path, 'w') as f:
-        json.dump(job_data, f, indent=4)
+    # Serialize in one go and write once; the job file is read by the .jsx script, so skip the indentation
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(job_data, separators=(',', ':')))
 
     print(f"\nSuccess! Job file created at: {output_path}")
     print("This file contains all the necessary information for your Premiere Pro script.")
@@ -2,12 +2,30 @@
 
 import os
 import json
-import time
-import ebooklib
-from ebooklib import epub
-from bs4 import BeautifulSoup
+import asyncio
+import hashlib
+import argparse
 import google.generativeai as genai
 import config # Use our new central config file
+from text_utils import get_book_text, load_api_key, strip_code_fences
+from api_utils import (
+    AsyncRateLimiter, backoff_delay, create_book_cache, delete_book_cache, extend_book_cache, fast_text, run_batch_job
+)
+
+MODEL_NAME = 'gemini-2.5-flash-lite'
+
+# Sub-topic scripts are generated concurrently; keep within the project's Gemini quota
+MAX_CONCURRENT_REQUESTS = 4
+REQUESTS_PER_MINUTE = 12
+# Shared by every Gemini request in the process (token bucket; waits only once the quota is used up)
+GEMINI_LIMITER = AsyncRateLimiter(REQUESTS_PER_MINUTE, 60)
+
+# Submit all sub-topics as one Gemini Batch API job instead of live requests:
+# cheaper and free of the per-minute quota, but results can take a long time to arrive
+USE_BATCH_API = False
+MANIFEST_FILE_NAME = 'manifest.json'
+# Attempts per sub-topic before it is reported as missing
+CHUNK_ATTEMPTS = 3
 
 INTRO_TEMPLATE = """
 Welcome to Nocturnal Knowledge.
@@ -20,54 +38,13 @@ please consider liking this video and subscribing for more deep dives into histo
 Our journey begins now.
 """
 
-# --- Helper Functions ---
+# --- Context Caching ---
 
-def get_book_text(epub_path):
-    """Opens an EPUB file and extracts all readable text content."""
-    print(f"Reading and parsing EPUB file from: {epub_path}")
-    try:
-        book = epub.read_epub(epub_path)
-        full_text = []
-        for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
-            soup = BeautifulSoup(item.get_content(), 'html.parser')
-            # Extract text and clean up whitespace
-            text = ' '.join(soup.get_text().split())
-            if text:
-                full_text.append(text)
-        print(f"Successfully extracted text from EPUB. Found {len(full_text)} content items.")
-        return "\n\n".join(full_text)
-    except FileNotFoundError:
-        print(f"Error: EPUB file not found at {epub_path}")
-        return None
-    except Exception as e:
-        print(f"An error occurred while parsing the EPUB: {e}")
-        return None
-
-def load_api_key():
-    """Loads the Google API key from the config file."""
-    try:
-        # Assumes config directory is one level up from the script's directory
-        config_dir = os.path.join(os.path.dirname(__file__), '..', 'config')
-        api_keys_path = os.path.join(config_dir, 'api_keys.json')
-        if not os.path.exists(api_keys_path):
-            print(f"Error: api_keys.json not found at {api_keys_path}. Please create it.")
-            return None
-        with open(api_keys_path, 'r') as f:
-            keys = json.load(f)
-            google_key = keys.get('google_api_key')
-            if not google_key:
-                print("Error: 'google_api_key' not found in api_keys.json.")
-                return None
-            return google_key
-    except FileNotFoundError:
-        print("Error: Configuration directory or api_keys.json not found.")
-        return None
-    except json.JSONDecodeError:
-        print("Error: Could not parse api_keys.json. Ensure it's valid JSON.")
-        return None
-    except Exception as e:
-        print(f"An unexpected error occurred loading API key: {e}")
-        return None
+def _book_reference(book_text, label):
+    """The prompt line that points the model at the book: inline text, or the cached context when book_text is None."""
+    if book_text is None:
+        return f"{label} The full book text is provided in the cached context."
+    return f"{label} --- {book_text} ---"
 
 # --- Phase 1: Generate Outline ---
 
@@ -100,14 +77,15 @@ def generate_historical_outline(book_text, book_title, model):
     - Each subtopic should represent a distinct, narratable point or event.
     - Focus on factual accuracy and historical significance as presented in the book.
 
-    Here is the full book text for your analysis: --- {book_text} ---
+    {_book_reference(book_text, "Here is the full book text for your analysis")}
     """
     
     try:
         response = model.generate_content(prompt)
+        response_text = fast_text(response) if response else None
         # Ensure response text is not None before attempting to strip/replace
-        if response and response.text:
-            cleaned_response = response.text.strip().replace('```json', '').replace('```', '')
+        if response_text:
+            cleaned_response = strip_code_fences(response_text)
             outline_data = json.loads(cleaned_response)
             
             print("Successfully generated flexible outline:")
@@ -121,23 +99,30 @@ def generate_historical_outline(book_text, book_title, model):
             return None
     except json.JSONDecodeError:
         print("  > Error: Failed to parse JSON response from AI.")
-        print(f"  > Raw response: {response.text if response and response.text else 'Empty response'}")
+        print(f"  > Raw response: {response_text or 'Empty response'}")
         return None
     except Exception as e:
         print(f"  > An error occurred during outline generation: {e}")
         return None
 
+def load_saved_outline(outline_path):
+    """Returns the outline saved by a previous run, or None if there is no usable one."""
+    try:
+        with open(outline_path, 'r', encoding='utf-8') as f:
+            outline_data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if not isinstance(outline_data, dict) or not outline_data.get('main_sections'):
+        return None
+    print(f"Reusing saved outline from: {outline_path}")
+    return outline_data
+
 # --- Phase 2: Generate ONE Substantial, Self-Contained Script Chunk ---
 
-def generate_historical_chunk(book_text, book_title, main_section_title, sub_topic_title, model):
-    """
-    Generates ONE single, self-contained, and detailed narration script for a subtopic.
-    It does NOT include transitions.
-    """
-    print(f"  > Phase 2: Writing self-contained script for sub-topic: '{sub_topic_title}'...")
-    
+def build_chunk_prompt(book_text, book_title, main_section_title, sub_topic_title):
+    """Builds the narration prompt for one sub-topic (shared by the direct and the Batch API paths)."""
     # --- MODIFIED PROMPT TO INCLUDE TARGET LENGTH ---
-    prompt = f"""
+    return f"""
     You are a historical documentarian writing a deep, engaging narration for a segment of a documentary.
     Your task is to write a single, comprehensive, and self-contained script explaining the sub-topic "{sub_topic_title}", which is part of the larger section "{main_section_title}" from the book "{book_title}".
 
@@ -150,13 +135,22 @@ def generate_historical_chunk(book_text, book_title, main_section_title, sub_top
     6.  **TARGET LENGTH:** Aim for a narration length of approximately **5 to 9 minutes**. This typically translates to **750-1200 words**, depending on speaking pace. Please ensure the output is a single, self-contained script segment that fits within this timeframe. If you need to prioritize depth over breadth to fit the length, do so.
     7.  **OUTPUT FORMAT:** Start with a markdown heading `## {sub_topic_title}`. Following the heading, write the narration directly in natural, well-formed paragraphs.
 
-    **Full Book Text for Reference:** --- {book_text} ---
+    {_book_reference(book_text, "**Full Book Text for Reference:**")}
     """
+
+async def generate_historical_chunk(book_text, book_title, main_section_title, sub_topic_title, model):
+    """
+    Generates ONE single, self-contained, and detailed narration script for a subtopic.
+    It does NOT include transitions.
+    """
+    print(f"  > Phase 2: Writing self-contained script for sub-topic: '{sub_topic_title}'...")
+    prompt = build_chunk_prompt(book_text, book_title, main_section_title, sub_topic_title)
     
     try:
-        response = model.generate_content(prompt)
-        if response and response.text and response.text.strip():
-            return response.text.strip()
+        response = await model.generate_content_async(prompt)
+        response_text = fast_text(response).strip() if response else None
+        if response_text:
+            return response_text
         else:
             print(f"    - Warning: Received empty or invalid response for script chunk '{sub_topic_title}'.")
             return None
@@ -164,72 +158,178 @@ def generate_historical_chunk(book_text, book_title, main_section_title, sub_top
         print(f"    - Error writing script chunk for '{sub_topic_title}': {e}")
         return None
 
+async def generate_chunks_with_batch(prompts, api_key, cached_content=None):
+    """Submits all sub-topic prompts as ONE Gemini Batch API job; returns the scripts in prompt order."""
+    return await run_batch_job(
+        api_key, MODEL_NAME, prompts, f'{config.BOOK_TITLE} sub-topic scripts', cached_content=cached_content
+    )
+
 # --- Phase 3: Process and Save ---
 
-def generate_and_save_all_chunks(book_text, book_title, author, outline_data, model):
+def _write_text(path, text):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+def chunk_file_name(chunk_index):
+    """File name of a chunk; `chunk_index` 0 is the intro."""
+    # Generate filename that aligns with how audio/image generators might find them.
+    # Using {i+1:02d} for zero-padded sequential numbering (e.g., 01, 02)
+    # This naming is intended to be consistent with how other scripts would find them.
+    file_number = str(chunk_index + 1).zfill(2)
+    return f"chunk_{file_number}.txt"
+
+def subtopic_key(section_title, subtopic):
+    """Identifies the outline entry a chunk was written for, so renamed sections aren't silently reused."""
+    return hashlib.sha1(f"{section_title}\x1f{subtopic}".encode('utf-8')).hexdigest()[:16]
+
+def load_manifest():
+    """Returns the {chunk file name: subtopic key} map of the chunks already generated."""
+    try:
+        with open(os.path.join(config.CHUNKS_DIR, MANIFEST_FILE_NAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_manifest(manifest):
+    try:
+        with open(os.path.join(config.CHUNKS_DIR, MANIFEST_FILE_NAME), 'w', encoding='utf-8') as f:
+            f.write(json.dumps(dict(sorted(manifest.items())), indent=2))
+    except Exception as e:
+        print(f"Error saving chunk manifest: {e}")
+
+async def save_chunk(chunk_index, chunk_content):
+    """Writes one chunk to chunk_NN.txt (off the event loop). `chunk_index` 0 is the intro."""
+    file_path = os.path.join(config.CHUNKS_DIR, chunk_file_name(chunk_index))
+    try:
+        await asyncio.to_thread(_write_text, file_path, chunk_content)
+        return True
+    except Exception as e:
+        print(f"Error saving chunk file '{file_path}': {e}")
+        return False
+
+def check_chunk_length(chunk, subtopic):
+    # --- CHUNK LENGTH MANAGEMENT ---
+    # Simple word count check as a proxy for time.
+    # Assuming a narration pace of ~150 words per minute for 7-9 minutes.
+    words_in_chunk = chunk.split()
+    estimated_minutes = len(words_in_chunk) / 150 
+    
+    if estimated_minutes > 9.5: # A bit of buffer, aiming for <10 min audio
+        print(f"    - WARNING: Generated chunk for '{subtopic}' is estimated to be over 10 minutes ({estimated_minutes:.1f} mins, {len(words_in_chunk)} words).")
+        print("    - NOTE: This script does NOT automatically split chunks. If AI output is consistently too long, manual review or a splitting mechanism would be needed.")
+        # For future implementation: Add logic here to split 'chunk' into smaller parts
+        # if it significantly exceeds the target length.
+
+async def generate_and_save_all_chunks(book_text, book_title, author, outline_data, model,
+                                      use_batch=USE_BATCH_API, api_key=None, cached_content=None, force=False):
     """
     Processes each sub-topic individually and saves it as its own substantial chunk file.
+    All sub-topic requests run concurrently, bounded by MAX_CONCURRENT_REQUESTS and
+    paced by the GEMINI_LIMITER token bucket, or, with `use_batch`, are submitted
+    together as a single Batch API job. Each chunk is written as soon as it arrives;
+    its file number comes from the outline position, not from completion order.
+    Sub-topics whose chunk file already exists and is recorded for the same
+    (section, subtopic) in the chunks manifest are skipped unless `force` is set.
+    Failed sub-topics are retried CHUNK_ATTEMPTS times. Returns the number of
+    chunks once all the outline's chunks exist, or 0 if any are still missing.
     """
-    all_final_script_chunks = []
-    
+    # Ensure the CHUNKS_DIR exists based on config
+    os.makedirs(config.CHUNKS_DIR, exist_ok=True)
+    print(f"\nSaving script chunks to '{config.CHUNKS_DIR}' as they are generated...")
+
     # Add the intro as the first chunk
     formatted_intro = INTRO_TEMPLATE.format(book_title=book_title, author=author).strip()
-    all_final_script_chunks.append(formatted_intro)
+    intro_saved = await save_chunk(0, formatted_intro)
 
     # --- ADAPTED LOOP FOR FLEXIBLE STRUCTURE ---
+    # Flatten the outline into (section, subtopic) pairs; their order is the chunk order
+    work_items = []
     for main_section in outline_data.get('main_sections', []):
         section_title = main_section.get('title', 'Unknown Section')
-        print(f"\n=== PROCESSING SECTION: {section_title} ===")
-        
         for subtopic in main_section.get('subtopics', []):
-            # Generate one single, self-contained chunk for the subtopic
-            chunk = generate_historical_chunk(book_text, book_title, section_title, subtopic, model)
-            
+            work_items.append((section_title, subtopic))
+
+    # Skip sub-topics that are already on disk for the same outline entry
+    manifest = {} if force else load_manifest()
+    new_manifest = {}
+    pending = []
+    for i, (section_title, subtopic) in enumerate(work_items):
+        file_name = chunk_file_name(i + 1)
+        key = subtopic_key(section_title, subtopic)
+        if manifest.get(file_name) == key and os.path.exists(os.path.join(config.CHUNKS_DIR, file_name)):
+            print(f"✓ Reusing existing script for: {subtopic}")
+            new_manifest[file_name] = key
+        else:
+            pending.append((i, section_title, subtopic))
+
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def _save(index, subtopic, chunk):
+        if not chunk:
+            print(f"✗ Failed to generate script for: {subtopic}.")
+            return False
+        check_chunk_length(chunk, subtopic)
+        # Sub-topic i follows the intro, so it is chunk i + 1
+        if not await save_chunk(index + 1, chunk):
+            return False
+        new_manifest[chunk_file_name(index + 1)] = subtopic_key(*work_items[index])
+        print(f"✓ Generated script for: {subtopic}")
+        return True
+
+    async def _generate(index, section_title, subtopic):
+        chunk = None
+        for attempt in range(CHUNK_ATTEMPTS):
+            if attempt:
+                delay = backoff_delay(attempt - 1, initial_delay=2)
+                print(f"    - Retrying '{subtopic}' in {delay:.1f}s (attempt {attempt + 1}/{CHUNK_ATTEMPTS})...")
+                await asyncio.sleep(delay)
+            async with sem:
+                async with GEMINI_LIMITER:
+                    # Generate one single, self-contained chunk for the subtopic
+                    chunk = await generate_historical_chunk(book_text, book_title, section_title, subtopic, model)
             if chunk:
-                # --- CHUNK LENGTH MANAGEMENT ---
-                # Simple word count check as a proxy for time.
-                # Assuming a narration pace of ~150 words per minute for 7-9 minutes.
-                words_in_chunk = chunk.split()
-                estimated_minutes = len(words_in_chunk) / 150 
-                
-                if estimated_minutes > 9.5: # A bit of buffer, aiming for <10 min audio
-                    print(f"    - WARNING: Generated chunk for '{subtopic}' is estimated to be over 10 minutes ({estimated_minutes:.1f} mins, {len(words_in_chunk)} words).")
-                    print("    - NOTE: This script does NOT automatically split chunks. If AI output is consistently too long, manual review or a splitting mechanism would be needed.")
-                    # For future implementation: Add logic here to split 'chunk' into smaller parts
-                    # if it significantly exceeds the target length.
-                
-                all_final_script_chunks.append(chunk)
-                print(f"✓ Generated script for: {subtopic}")
-            else:
-                print(f"✗ Failed to generate script for: {subtopic}. Halting.")
-                return 0 # Stop if a critical chunk fails
-            
-            time.sleep(5) # Wait between AI calls for script chunks to avoid rate limiting
+                break
+        return await _save(index, subtopic, chunk)
 
-    # Ensure the CHUNKS_DIR exists based on config
-    os.makedirs(config.CHUNKS_DIR, exist_ok=True)
-    print(f"\nSaving {len(all_final_script_chunks)} script chunks to '{config.CHUNKS_DIR}'...")
-
-    # Save each chunk to a file
-    for i, chunk_content in enumerate(all_final_script_chunks):
-        # Generate filename that aligns with how audio/image generators might find them.
-        # Using {i+1:02d} for zero-padded sequential numbering (e.g., 01, 02)
-        # This naming is intended to be consistent with how other scripts would find them.
-        file_number = str(i + 1).zfill(2) 
-        file_path = os.path.join(config.CHUNKS_DIR, f"chunk_{file_number}.txt")
-        
-        try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(chunk_content)
-        except Exception as e:
-            print(f"Error saving chunk file '{file_path}': {e}")
-            continue # Skip saving this file and continue with the next
-    
-    print(f"\nScript successfully saved as {len(all_final_script_chunks)} substantial chunks.")
-    return len(all_final_script_chunks)
+    if not pending:
+        saved = []
+    elif use_batch:
+        print(f"\n=== Generating {len(pending)} sub-topic scripts as one batch job ===")
+        prompts = [build_chunk_prompt(book_text, book_title, section, subtopic) for _, section, subtopic in pending]
+        results = await generate_chunks_with_batch(prompts, api_key, cached_content)
+        saved = [await _save(i, subtopic, chunk) for (i, _, subtopic), chunk in zip(pending, results)]
+    else:
+        print(f"\n=== Generating {len(pending)} sub-topic scripts (up to {MAX_CONCURRENT_REQUESTS} at a time) ===")
+        saved = await asyncio.gather(
+            *(_generate(i, section, subtopic) for i, section, subtopic in pending),
+            return_exceptions=True
+        )
+    save_manifest(new_manifest)
+
+    for (_, _, subtopic), result in zip(pending, saved):
+        if isinstance(result, Exception):
+            print(f"    - Error writing script chunk for '{subtopic}': {result}")
+
+    # Success means every chunk the outline calls for is on disk, whichever run produced it.
+    # The manifest (not just the file's existence) tells us a chunk matches its current sub-topic.
+    expected_files = [chunk_file_name(i) for i in range(len(work_items) + 1)]
+    missing = [name for name in expected_files[1:] if name not in new_manifest]
+    if not intro_saved:
+        missing.insert(0, expected_files[0])
+    if missing:
+        print(f"\n✗ {len(missing)} of {len(expected_files)} chunks are still missing: {', '.join(missing)}")
+        return 0
+
+    print(f"\nScript successfully saved as {len(expected_files)} substantial chunks.")
+    return len(expected_files)
 
 # --- MAIN EXECUTION BLOCK ---
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the historical documentary script chunks for the configured book.")
+    parser.add_argument('--force', action='store_true',
+                        help="Regenerate the outline and every sub-topic script instead of resuming from the saved ones.")
+    args = parser.parse_args()
+
     # Ensure BOOK_TITLE is correctly formatted for directory creation and display
     # Replace underscores with spaces, and remove common punctuation that might cause issues in paths.
     BOOK_TITLE_PROCESSED = config.BOOK_TITLE.replace("_", " ").replace(":", "").replace(",", "").replace("'", "").replace('"', '')
@@ -241,7 +341,7 @@ if __name__ == "__main__":
     if not os.path.exists(book_file_path):
         print(f"Error: The book EPUB file was not found at '{book_file_path}'")
     else:
-        api_key = load_api_key()
+        api_key = load_api_key('google')
         if not api_key:
             print("Halting execution: Could not load Google API key.")
         else:
@@ -249,7 +349,7 @@ if __name__ == "__main__":
                 # Configure the GenAI client and load the model
                 genai.configure(api_key=api_key)
                 # Using 'gemini-2.5-flash-lite' as it's generally good for text generation tasks.
-                model = genai.GenerativeModel('gemini-2.5-flash-lite') 
+                model = genai.GenerativeModel(MODEL_NAME)
                 print("✓ Google GenAI client configured and model loaded.")
             except Exception as e:
                 print(f"✗ Failed to configure GenAI client or load model: {e}")
@@ -259,36 +359,59 @@ if __name__ == "__main__":
             full_book_text = get_book_text(book_file_path)
             
             if full_book_text:
-                # --- STEP 2: Generate Outline ---
-                # FIX: Removed config.AUTHOR from this call as generate_historical_outline only expects 3 args.
-                outline_data = generate_historical_outline(full_book_text, BOOK_TITLE_PROCESSED, model)
-                
-                if outline_data:
-                    # --- STEP 3: Save Outline ---
+                # Upload the book once; every request below references the cache instead of re-sending it
+                book_cache = create_book_cache(full_book_text, MODEL_NAME, BOOK_TITLE_PROCESSED)
+                prompt_book_text = full_book_text
+                if book_cache:
+                    model = genai.GenerativeModel.from_cached_content(book_cache)
+                    prompt_book_text = None
+
+                try:
                     # Define outline path relative to config.BOOK_DIR
                     outline_path = os.path.join(config.BOOK_DIR, 'detailed_outline.json')
-                    try:
-                        with open(outline_path, 'w', encoding='utf-8') as f:
-                            json.dump(outline_data, f, indent=2)
-                        print(f"Detailed outline saved to: {outline_path}")
-                    except Exception as e:
-                        print(f"Error saving detailed outline JSON: {e}")
-                    
-                    # --- STEP 4: Generate and Save Script Chunks ---
-                    total_chunks_generated = generate_and_save_all_chunks(
-                        full_book_text, 
-                        BOOK_TITLE_PROCESSED, 
-                        AUTHOR, # AUTHOR is used in INTRO_TEMPLATE, so keep it here for the intro chunk
-                        outline_data, 
-                        model
-                    )
+                    # Reuse the saved outline so an interrupted run resumes with the same sub-topics
+                    outline_data = None if args.force else load_saved_outline(outline_path)
+
+                    if not outline_data:
+                        # --- STEP 2: Generate Outline ---
+                        # FIX: Removed config.AUTHOR from this call as generate_historical_outline only expects 3 args.
+                        outline_data = generate_historical_outline(prompt_book_text, BOOK_TITLE_PROCESSED, model)
+                
+                        if outline_data:
+                            # --- STEP 3: Save Outline ---
+                            try:
+                                with open(outline_path, 'w', encoding='utf-8') as f:
+                                    f.write(json.dumps(outline_data, indent=2))
+                                print(f"Detailed outline saved to: {outline_path}")
+                            except Exception as e:
+                                print(f"Error saving detailed outline JSON: {e}")
+
+                    if outline_data:
+                        cached_content = book_cache.name if book_cache else None
+                        if USE_BATCH_API and book_cache and not extend_book_cache(book_cache):
+                            # The batch job could outlive the cache, so its prompts carry the book
+                            prompt_book_text, cached_content = full_book_text, None
+
+                        # --- STEP 4: Generate and Save Script Chunks ---
+                        total_chunks_generated = asyncio.run(generate_and_save_all_chunks(
+                            prompt_book_text, 
+                            BOOK_TITLE_PROCESSED, 
+                            AUTHOR, # AUTHOR is used in INTRO_TEMPLATE, so keep it here for the intro chunk
+                            outline_data, 
+                            model,
+                            api_key=api_key,
+                            cached_content=cached_content,
+                            force=args.force
+                        ))
                     
-                    if total_chunks_generated > 0: 
-                        print(f"\n🎉 SUCCESS! Generated {total_chunks_generated} script chunks.")
+                        if total_chunks_generated > 0: 
+                            print(f"\n🎉 SUCCESS! All {total_chunks_generated} script chunks are in place.")
+                        else:
+                            print("\nProcess completed, but some script chunks are still missing. Re-run to generate only those.")
                     else:
-                        print("\nProcess completed, but script generation failed or produced no chunks.")
-                else:
-                    print("\nHalting execution: Failed to generate the historical outline.")
+                        print("\nHalting execution: Failed to generate the historical outline.")
+                finally:
+                    delete_book_cache(book_cache)
             else:
                 print("\nHalting execution: Could not retrieve book text from EPUB.")
 
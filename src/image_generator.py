@@ -1,14 +1,36 @@
 import os
+import re
 import json
-import time
-import glob
-import google.genai as genai
+import argparse
+import hashlib
+import shutil
+import functools
+import asyncio
 from google.genai import types
-from PIL import Image
-from io import BytesIO
-from natsort import natsorted
+from path_utils import CHUNK_FILE_RE, group_images_by_part, scan_files, sorted_by_part
 import config  # Use our new central config file
+from text_utils import strip_code_fences
+from api_utils import AsyncRateLimiter, async_call_with_retry, fast_text, make_genai_client
 
+# How many Imagen requests may be in flight at once; size this to the project's Imagen quota
+MAX_CONCURRENT_IMAGEN = 4
+# Per-endpoint request quotas (per minute); adjust to the project's tier.
+# Requests only wait once a quota is used up, instead of sleeping after every call.
+GEMINI_LIMITER = AsyncRateLimiter(max_rate=60, time_period=60)
+IMAGEN_LIMITER = AsyncRateLimiter(max_rate=20, time_period=60)
+# Parts whose images are generated at the same time while prompts for later parts are being written
+CONSUMER_COUNT = 2
+# Parts whose image prompts are requested together; small enough that images for the first
+# batch start while later batches are still being written, and the reply stays short
+PROMPT_PARTS_PER_REQUEST = 4
+
+EXISTING_IMAGE_RE = re.compile(r'_img_(\d+)\.png$')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Reuse images from config.IMAGES_CACHE_DIR for prompts that were already rendered
+USE_IMAGE_CACHE = True
+
+@functools.lru_cache(maxsize=1)
 def load_configs():
     """Loads API keys and visual style configurations."""
     try:
@@ -22,7 +44,7 @@ def load_configs():
         print(f"Error loading configuration files: {e}")
         return None, None
 
-def generate_contextual_image_prompts(text_chunk, book_style_config, client, num_images, part_number, total_parts):
+async def generate_contextual_image_prompts(text_chunk, book_style_config, client, num_images, part_number, total_parts):
     """
     Enhanced prompt generation that creates contextually relevant images
     and respects text preferences from the style config.
@@ -58,11 +80,12 @@ def generate_contextual_image_prompts(text_chunk, book_style_config, client, num
     """
     
     try:
-        response = client.models.generate_content(
-            model='models/gemini-2.5-flash-lite',
-            contents=[style_prompt]
-        )
-        cleaned_response = response.text.strip().replace('```json', '').replace('```', '')
+        async with GEMINI_LIMITER:
+            response = await client.aio.models.generate_content(
+                model='models/gemini-2.5-flash-lite',
+                contents=[style_prompt]
+            )
+        cleaned_response = strip_code_fences(fast_text(response))
         image_prompts = json.loads(cleaned_response)
         
         if len(image_prompts) != num_images:
@@ -74,20 +97,111 @@ def generate_contextual_image_prompts(text_chunk, book_style_config, client, num
         print(f"  > Error generating prompts: {e}")
         return []
 
-def generate_and_save_images(client, image_prompts, part_number):
+async def generate_all_contextual_prompts(chunk_texts, book_style_config, client, num_images, total_parts):
+    """
+    Generates the image prompts for several parts in a single request instead of one
+    request per part. `chunk_texts` maps part number -> text. Returns a dict of
+    part number -> list of prompts; parts missing from (or malformed in) the reply
+    are left out so the caller can fall back to generate_contextual_image_prompts.
+    """
+    print(f"  > Generating {num_images} contextual prompts for each of {len(chunk_texts)} parts in one request...")
+
+    text_preference = book_style_config.get('image_text_preference', 'text okay')
+
+    text_instruction = ""
+    if text_preference == 'no text':
+        text_instruction = "5. CRITICAL: The generated images must NOT contain any text, letters, words, or numbers whatsoever."
+
+    parts_block = "\n\n".join(f"### PART {part}\n{text}" for part, text in chunk_texts.items())
+
+    style_prompt = f"""
+    You are creating visual accompaniments for an audiobook.
+
+    BOOK CONTEXT:
+    - The book has {total_parts} total parts; the parts below are labelled "### PART <number>"
+    - Visual Style: {book_style_config['style']}
+    - Themes: {', '.join(book_style_config['themes'])}
+
+    TEXT OF THE PARTS:
+    {parts_block}
+
+    For EACH part, create {num_images} distinct, high-quality **image prompts** that follow these rules:
+    1. Directly relate to the key concepts in that specific part's text.
+    2. Progress visually to complement the narration flow.
+    3. Are suitable for 16:9 aspect ratio video.
+    4. Match the overall book's visual style and themes.
+    5. Don't include any text
+    {text_instruction} 
+
+    Output ONLY a valid JSON object mapping each part number (as a string, exactly as labelled) to an array of {num_images} descriptive prompt STRINGS.
     """
-    Generates and saves images using Imagen, with added pauses and robust
-    handling for incorrectly formatted prompts from the LLM.
+
+    try:
+        async with GEMINI_LIMITER:
+            response = await client.aio.models.generate_content(
+                model='models/gemini-2.5-flash-lite',
+                contents=[style_prompt]
+            )
+        prompts_by_part = json.loads(strip_code_fences(fast_text(response)))
+    except Exception as e:
+        print(f"  > Error generating batched prompts, falling back to one request per part: {e}")
+        return {}
+
+    if not isinstance(prompts_by_part, dict):
+        print("  > Batched prompt response was not a JSON object, falling back to one request per part.")
+        return {}
+
+    # The model may echo "01" back as "1"; compare part numbers, not strings
+    prompts_by_number = {}
+    for key, image_prompts in prompts_by_part.items():
+        try:
+            prompts_by_number[int(key)] = image_prompts
+        except (TypeError, ValueError):
+            continue
+
+    result = {}
+    for part in chunk_texts:
+        image_prompts = prompts_by_number.get(int(part))
+        if isinstance(image_prompts, list) and image_prompts:
+            result[part] = image_prompts
+    print(f"  > Generated prompts for {len(result)}/{len(chunk_texts)} parts in one request (Text preference: '{text_preference}').")
+    return result
+
+def _read_text(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def _save_image(image_bytes, filename, cache_path=None):
+    """Writes the image to disk as-is: Imagen already returns PNG bytes, so no decode/re-encode is needed."""
+    with open(filename, 'wb') as f:
+        f.write(image_bytes)
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, 'wb') as f:
+            f.write(image_bytes)
+
+def image_cache_path(prompt):
+    """Content-addressed cache location for the image of a prompt (case and whitespace don't matter)."""
+    normalized = _WHITESPACE_RE.sub(' ', prompt).strip().lower()
+    digest = hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).hexdigest()
+    return os.path.join(config.IMAGES_CACHE_DIR, f"{digest}.png")
+
+async def generate_and_save_images(client, image_prompts, part_number, sem=None, indices=None):
+    """
+    Generates and saves images using Imagen, with all prompts of the part in flight
+    concurrently (bounded by `sem`) and robust handling for incorrectly formatted
+    prompts from the LLM. Quota errors are retried with exponential backoff.
+    If `indices` is given, only the images at those (0-based) positions are generated.
     """
     if not image_prompts:
         print("    >> No image prompts provided, skipping image generation.")
         return False
 
     os.makedirs(config.IMAGES_DIR, exist_ok=True)
+    if sem is None:
+        sem = asyncio.Semaphore(MAX_CONCURRENT_IMAGEN)
 
-    success_count = 0
-    for i, item in enumerate(image_prompts):
-        
+    async def _generate_one(i, item):
         # --- FIX for Pydantic Error: Check the prompt format before using it ---
         final_prompt = ""
         if isinstance(item, str):
@@ -97,53 +211,160 @@ def generate_and_save_images(client, image_prompts, part_number):
             final_prompt = item['prompt']
         else:
             print(f"    >> ✗ Error: Unrecognized prompt format for image {i+1}. Skipping. Data: {item}")
-            continue
+            return 0
         # --------------------------------------------------------------------
 
         filename = os.path.join(config.IMAGES_DIR, f"image_part_{part_number}_img_{i+1}.png")
-        print(f"    >> Generating image {i+1}/{len(image_prompts)} for part {part_number}")
-        
-        try:
-            response = client.models.generate_images(
-                model='models/imagen-3.0-generate-002',
-                prompt=final_prompt, # Use the corrected, guaranteed-to-be-string variable
-                config=types.GenerateImagesConfig(
-                    number_of_images=1,
-                    aspect_ratio="16:9",
+
+        # Identical prompts (common across parts of thematic books) reuse the image instead of calling Imagen
+        cache_path = image_cache_path(final_prompt) if USE_IMAGE_CACHE else None
+        if cache_path and os.path.exists(cache_path):
+            await asyncio.to_thread(shutil.copyfile, cache_path, filename)
+            print(f"    >> ✓ Saved (cached): {filename}")
+            return 1
+
+        async def _request():
+            async with sem, IMAGEN_LIMITER:
+                print(f"    >> Generating image {i+1}/{len(image_prompts)} for part {part_number}")
+                return await client.aio.models.generate_images(
+                    model='models/imagen-3.0-generate-002',
+                    prompt=final_prompt, # Use the corrected, guaranteed-to-be-string variable
+                    config=types.GenerateImagesConfig(
+                        number_of_images=1,
+                        aspect_ratio="16:9",
+                    )
                 )
+
+        try:
+            # Quota errors back off and retry this image only, instead of pausing every request
+            response = await async_call_with_retry(
+                _request, initial_delay=5, max_delay=60, label=f"image {i+1} of part {part_number}"
             )
 
+            saved = 0
             for generated_image in response.generated_images:
-                image_data = generated_image.image.image_bytes
-                image = Image.open(BytesIO(image_data))
-                image.save(filename)
+                # Writing the file would otherwise block the event loop
+                await asyncio.to_thread(_save_image, generated_image.image.image_bytes, filename, cache_path)
                 print(f"    >> ✓ Saved: {filename}")
-                success_count += 1
+                saved += 1
+            return saved
 
         except Exception as e:
-            error_message = str(e)
-            if "RESOURCE_EXHAUSTED" in error_message or "Quota" in error_message:
-                print("    >> ✗ Hit API rate limit. Pausing for 60 seconds before continuing...")
-                time.sleep(60)
-            else:
-                print(f"    >> ✗ An unknown error occurred generating image {i+1}: {e}")
-            continue
+            print(f"    >> ✗ An error occurred generating image {i+1}: {e}")
+            return 0
 
-        # Add a pause AFTER each successful image generation to respect rate limits
-        if i < len(image_prompts) - 1: # Don't sleep after the last image of the part
-            print("    >> Pausing for 5 seconds...")
-            time.sleep(5)
+    results = await asyncio.gather(*(
+        _generate_one(i, item) for i, item in enumerate(image_prompts) if indices is None or i in indices
+    ))
+    success_count = sum(results)
 
-    print(f"    >> Part {part_number} complete: {success_count}/{len(image_prompts)} images generated")
+    # With `indices` only some images were attempted; report against those
+    print(f"    >> Part {part_number} complete: {success_count}/{len(results)} images generated")
     return success_count > 0
 
-def main():
+def existing_image_indices(image_paths):
+    """Returns the 0-based indices of a part's saved images, given their paths."""
+    indices = set()
+    for path in image_paths:
+        match = EXISTING_IMAGE_RE.search(os.path.basename(path))
+        if match:
+            indices.add(int(match.group(1)) - 1)
+    return indices
+
+def select_parts_to_process(parts_to_process, regenerate, num_images_per_part):
+    """
+    Decides up front which parts (and which images of each part) to generate, based on
+    the --regenerate mode: 'all' redoes everything, 'missing' fills in only the images
+    that don't exist yet, 'none' skips any part that already has images.
+    Returns (chunk_path, part_num_str, indices) tuples; `indices` None means all images.
+    """
+    selected = []
+    # One scan of the images directory covers every part
+    images_by_part = group_images_by_part(config.IMAGES_DIR) if regenerate != 'all' else {}
+    for chunk_path in parts_to_process:
+        part_num_str = os.path.basename(chunk_path).replace('chunk_', '').replace('.txt', '')
+
+        existing = existing_image_indices(images_by_part.get(int(part_num_str), []))
+        if not existing:
+            selected.append((chunk_path, part_num_str, None))
+            continue
+
+        missing = set(range(num_images_per_part)) - existing
+        if regenerate == 'none' or not missing:
+            print(f"  > Found {len(existing)} existing images for part {part_num_str}. Skipping.")
+            continue
+        print(f"  > Part {part_num_str}: generating {len(missing)} missing image(s).")
+        selected.append((chunk_path, part_num_str, missing))
+    return selected
+
+async def process_parts(client, parts_to_process, total_parts, book_style, num_images_per_part):
+    """
+    Pipelines the two endpoints: a producer writes the prompts (Gemini), PROMPT_PARTS_PER_REQUEST
+    parts per request where possible, while consumers turn them into images (Imagen).
+    """
+    sem = asyncio.Semaphore(MAX_CONCURRENT_IMAGEN)
+    # Bounded, so prompt generation can't run arbitrarily far ahead of the images
+    prompt_queue = asyncio.Queue(maxsize=4)
+
+    async def producer():
+        try:
+            for start in range(0, len(parts_to_process), PROMPT_PARTS_PER_REQUEST):
+                batch = parts_to_process[start:start + PROMPT_PARTS_PER_REQUEST]
+                chunk_texts = {}
+                for chunk_path, part_num_str, _ in batch:
+                    chunk_texts[part_num_str] = await asyncio.to_thread(_read_text, chunk_path)
+
+                # One request per batch of parts; only parts it didn't cover get their own request
+                batched_prompts = await generate_all_contextual_prompts(
+                    chunk_texts, book_style, client, num_images_per_part, total_parts
+                )
+
+                # Covered parts go to the consumers right away, before any fallback requests
+                fallback = []
+                for _, part_num_str, indices in batch:
+                    image_prompts = batched_prompts.get(part_num_str)
+                    if image_prompts:
+                        print(f"\n--- Queued Part {part_num_str}/{total_parts} ---")
+                        await prompt_queue.put((part_num_str, image_prompts, indices))
+                    else:
+                        fallback.append((part_num_str, indices))
+
+                for part_num_str, indices in fallback:
+                    print(f"\n--- Processing Part {part_num_str}/{total_parts} ---")
+                    image_prompts = await generate_contextual_image_prompts(
+                        chunk_texts[part_num_str], book_style, client, num_images_per_part, part_num_str, total_parts
+                    )
+                    if image_prompts:
+                        await prompt_queue.put((part_num_str, image_prompts, indices))
+        finally:
+            # One sentinel per consumer so each of them exits once the queue drains
+            for _ in range(CONSUMER_COUNT):
+                await prompt_queue.put(None)
+
+    async def consumer():
+        while True:
+            item = await prompt_queue.get()
+            if item is None:
+                return
+            part_num_str, image_prompts, indices = item
+            await generate_and_save_images(client, image_prompts, part_num_str, sem, indices)
+
+    await asyncio.gather(producer(), *[consumer() for _ in range(CONSUMER_COUNT)])
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate images for each text chunk of the book.")
+    parser.add_argument('--regenerate', choices=['all', 'missing', 'none'], default='missing',
+                        help="What to do with parts that already have images (default: generate only the missing ones).")
+    return parser.parse_args(argv)
+
+def main(argv=None):
     """
     Main function that reads text chunks and generates corresponding images,
     intelligently skipping parts that are already complete.
     """
     TEST_MODE = False
     NUM_IMAGES_PER_PART = 5
+    args = parse_args(argv)
 
     print(f"=== Dynamic Image Generation for '{config.BOOK_TITLE}' ===")
     
@@ -158,14 +379,14 @@ def main():
         return
     
     try:
-        client = genai.Client(api_key=api_keys['google_api_key'])
+        client = make_genai_client(api_keys['google_api_key'])
         print("✓ Google GenAI Client initialized successfully.")
     except Exception as e:
         print(f"✗ Failed to create GenAI Client: {e}")
         return
 
     # Find the text chunks to process (our "single source of truth")
-    chunk_files = natsorted(glob.glob(os.path.join(config.CHUNKS_DIR, 'chunk_*.txt')))
+    chunk_files = sorted_by_part(scan_files(config.CHUNKS_DIR, CHUNK_FILE_RE))
     if not chunk_files:
         print(f"FATAL ERROR: No chunk files found in {config.CHUNKS_DIR}")
         print("Please run master_script_generator.py first.")
@@ -178,33 +399,8 @@ def main():
     
     print(f"\n--- Found {len(chunk_files)} text chunks. Starting image generation. ---")
 
-    for chunk_path in parts_to_process:
-        part_num_str = os.path.basename(chunk_path).replace('chunk_', '').replace('.txt', '')
-        print(f"\n--- Checking Part {part_num_str}/{len(chunk_files)} ---")
-
-        # Skip if images already exist
-        image_search_pattern = os.path.join(config.IMAGES_DIR, f'image_part_{part_num_str}_img_*.png')
-        existing_images = glob.glob(image_search_pattern)
-        
-        if existing_images:
-            print(f"  > Found {len(existing_images)} existing images for part {part_num_str}.")
-            user_input = input("  > Do you want to regenerate them? (y/n): ").lower()
-            if user_input != 'y':
-                print(f"  > Skipping part {part_num_str}.")
-                continue
-        
-        print(f"--- Processing Part {part_num_str} ---")
-        with open(chunk_path, 'r', encoding='utf-8') as f:
-            text_for_prompts = f.read()
-        
-        image_prompts = generate_contextual_image_prompts(
-            text_for_prompts, book_style, client, NUM_IMAGES_PER_PART, part_num_str, len(chunk_files)
-        )
-        if image_prompts:
-            generate_and_save_images(client, image_prompts, part_num_str)
-        
-        # This is a longer pause between entire parts
-        time.sleep(5)
+    parts_to_process = select_parts_to_process(parts_to_process, args.regenerate, NUM_IMAGES_PER_PART)
+    asyncio.run(process_parts(client, parts_to_process, len(chunk_files), book_style, NUM_IMAGES_PER_PART))
 
     print("\n\n=== Image Generation Complete! ===")
 
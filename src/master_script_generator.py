@@ -1,11 +1,33 @@
 import os
 import json
-import time
-import ebooklib
-from ebooklib import epub
-from bs4 import BeautifulSoup
+import asyncio
+import hashlib
+from typing import TypedDict
 import google.generativeai as genai
 import config
+from text_utils import get_book_text, load_api_key, strip_code_fences
+from api_utils import AsyncRateLimiter, create_book_cache, delete_book_cache, extend_book_cache, run_batch_job
+
+# Subtopic scripts are generated concurrently; keep within the project's Gemini quota
+MAX_CONCURRENT_REQUESTS = 4
+REQUESTS_PER_MINUTE = 12
+GEMINI_LIMITER = AsyncRateLimiter(REQUESTS_PER_MINUTE, 60)
+
+MODEL_NAME = 'gemini-2.0-flash'
+# Submit all subtopics as one Gemini Batch API job instead of live requests:
+# about half the price, but results can take a long time to arrive
+USE_BATCH_API = False
+# Request a main topic's subtopics a few at a time in structured-JSON calls instead of one call
+# each: fewer requests when the RPM quota is the bottleneck, at the cost of longer responses
+GROUP_SUBTOPICS_BY_TOPIC = False
+# A subtopic's 8-10 minute script is ~2k output tokens; with JSON escaping, more than two per
+# request would run into gemini-2.0-flash's 8192-token output cap and come back truncated
+MAX_SUBTOPICS_PER_REQUEST = 2
+MAX_OUTPUT_TOKENS = 8192
+
+class SubtopicScript(TypedDict):
+    subtitle: str
+    markdown_script: str
 
 INTRO_TEMPLATE = """
 Welcome to Nocturnal Knowledge.
@@ -19,33 +41,106 @@ Our journey begins now.
 """
 
 # --- Helper Functions ---
-def get_book_text(epub_path):
-    """Opens an EPUB file and extracts all readable text content."""
-    print(f"Reading and parsing EPUB file from: {epub_path}")
+
+# Responses already seen in this process, keyed like the on-disk cache
+_response_cache = {}
+# Digest of the book the prompts refer to; with context caching the prompts no longer contain it
+_book_digest = ''
+
+def set_response_cache_book(book_text):
+    """Ties cached responses to this book's text, so an edited EPUB never reuses stale answers."""
+    global _book_digest
+    _book_digest = hashlib.sha256(book_text.encode('utf-8')).hexdigest()
+
+def _response_cache_path(prompt):
+    """Disk cache entry for a prompt: re-runs with a byte-identical prompt skip the LLM call."""
+    digest = hashlib.sha256(f"{MODEL_NAME}\0{_book_digest}\0{prompt}".encode('utf-8')).hexdigest()
+    return os.path.join(config.BOOK_CACHE_DIR, 'llm', f"{digest}.txt")
+
+def get_cached_response(prompt):
+    path = _response_cache_path(prompt)
+    if path in _response_cache:
+        return _response_cache[path]
     try:
-        book = epub.read_epub(epub_path)
-        full_text = []
-        for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
-            soup = BeautifulSoup(item.get_content(), 'html.parser')
-            text = ' '.join(soup.get_text().split())
-            full_text.append(text)
-        print("Successfully extracted text from EPUB.")
-        return "\n\n".join(full_text)
-    except Exception as e:
-        print(f"An error occurred while parsing the EPUB: {e}")
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    except FileNotFoundError:
         return None
+    _response_cache[path] = text
+    return text
 
-def load_api_key():
-    """Loads the Google API key from the config file."""
+def store_cached_response(prompt, text):
+    path = _response_cache_path(prompt)
+    _response_cache[path] = text
     try:
-        with open('../config/api_keys.json', 'r') as f:
-            keys = json.load(f)
-            return keys['google_api_key']
-    except Exception as e:
-        print(f"Error loading API key: {e}")
-        return None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+    except OSError as e:
+        print(f"Warning: Could not write LLM response cache: {e}")
+
+def discard_cached_response(prompt):
+    path = _response_cache_path(prompt)
+    _response_cache.pop(path, None)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def cached_generate(model, prompt, parse=None):
+    """
+    model.generate_content(prompt).text, served from the prompt-hash cache when possible.
+    With `parse`, returns parse(text) instead, and a response is only cached once it parses:
+    a truncated or malformed answer raises without being stored, and a cached one that no
+    longer parses is discarded and requested again.
+    """
+    text = get_cached_response(prompt)
+    if text is not None:
+        try:
+            return parse(text) if parse else text
+        except Exception:
+            discard_cached_response(prompt)
+    text = model.generate_content(prompt).text
+    result = parse(text) if parse else text
+    if text:
+        store_cached_response(prompt, text)
+    return result
+
+async def cached_generate_async(model, prompt, generation_config=None, parse=None):
+    """Async version of cached_generate."""
+    text = get_cached_response(prompt)
+    if text is not None:
+        try:
+            return parse(text) if parse else text
+        except Exception:
+            discard_cached_response(prompt)
+    response = await model.generate_content_async(prompt, generation_config=generation_config)
+    text = response.text
+    result = parse(text) if parse else text
+    if text:
+        store_cached_response(prompt, text)
+    return result
+
+def _book_text_block(book_text, heading):
+    """The book section of a prompt: the inline text, or a pointer to the cached context when book_text is None."""
+    if book_text is None:
+        return f"{heading} The full book text is provided in the cached context."
+    return f"""{heading}
+    --- BOOK TEXT BEGINS ---
+    {book_text}
+    --- BOOK TEXT ENDS ---"""
 
 # --- Phase 1: Generate Detailed Topic Breakdown ---
+OUTLINE_SUBTOPIC_KEYS = {'subtitle', 'key_concepts', 'estimated_duration'}
+
+def parse_outline(response_text):
+    """Parses the outline JSON, raising if it is malformed or misses fields the later phases use."""
+    outline_data = json.loads(strip_code_fences(response_text))
+    for topic in outline_data['main_topics']:
+        if 'title' not in topic or not all(OUTLINE_SUBTOPIC_KEYS <= subtopic.keys() for subtopic in topic['subtopics']):
+            raise ValueError(f"Outline topic is missing fields: {topic}")
+    return outline_data
+
 def generate_detailed_outline(book_text, book_title, model):
     """Creates a comprehensive outline with main topics and detailed subtopics."""
     print("Generating detailed topic breakdown...")
@@ -78,16 +173,11 @@ def generate_detailed_outline(book_text, book_title, model):
     - Each main topic should have 3-5 detailed subtopics
     - Focus on actionable insights and deep philosophical concepts from the book.
 
-    Here is the full book text:
-    --- BOOK TEXT BEGINS ---
-    {book_text}
-    --- BOOK TEXT ENDS ---
+    {_book_text_block(book_text, "Here is the full book text:")}
     """
     
     try:
-        response = model.generate_content(prompt)
-        cleaned_response = response.text.strip().replace('```json', '').replace('```', '')
-        outline_data = json.loads(cleaned_response)
+        outline_data = cached_generate(model, prompt, parse=parse_outline)
         
         print("Successfully generated detailed outline:")
         for i, topic in enumerate(outline_data['main_topics']):
@@ -101,15 +191,11 @@ def generate_detailed_outline(book_text, book_title, model):
         return None
 
 # --- Phase 2: Generate Detailed Script for Each Subtopic ---
-def generate_detailed_script_chunk(book_text, book_title, subtopic_data, previous_context, model):
-    """
-    Generates a comprehensive, detailed script for a specific subtopic with natural flow.
-    """
-    print(f"\nGenerating detailed script for: '{subtopic_data['subtitle']}'...")
-
+def build_script_prompt(book_text, book_title, subtopic_data, previous_context):
+    """Builds the narration prompt for one subtopic (shared by the direct and the Batch API paths)."""
     key_concepts_str = ', '.join(subtopic_data['key_concepts'])
     
-    prompt = f"""
+    return f"""
     You are writing a detailed audiobook narration for "{book_title}".
 
     **CURRENT SECTION:** {subtopic_data['subtitle']}
@@ -125,43 +211,174 @@ def generate_detailed_script_chunk(book_text, book_title, subtopic_data, previou
     4. **TONE:** Write like a thoughtful narrator exploring the book's ideas in depth, as if having an intimate conversation with the listener.
     5. **FORMAT:** Start with the markdown heading `## {subtopic_data['subtitle']}` and then write the narration in natural, spoken-word paragraphs.
 
-    **BOOK TEXT FOR REFERENCE:**
-    ---
-    {book_text}
-    ---
+    {_book_text_block(book_text, "**BOOK TEXT FOR REFERENCE:**")}
+    """
+
+async def generate_detailed_script_chunk(book_text, book_title, subtopic_data, previous_context, model):
+    """
+    Generates a comprehensive, detailed script for a specific subtopic with natural flow.
     """
+    print(f"\nGenerating detailed script for: '{subtopic_data['subtitle']}'...")
+    prompt = build_script_prompt(book_text, book_title, subtopic_data, previous_context)
     
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        return await cached_generate_async(model, prompt)
     except Exception as e:
         print(f"An error occurred during script generation for '{subtopic_data['subtitle']}': {e}")
         return None
 
+def build_topic_prompt(book_text, book_title, group):
+    """Builds one prompt asking for the scripts of several subtopics; `group` is a list of (subtopic, previous_context)."""
+    sections = []
+    for n, (subtopic_data, previous_context) in enumerate(group, start=1):
+        sections.append(f"""
+    ### SUBTOPIC {n}
+    **CURRENT SECTION:** {subtopic_data['subtitle']}
+    **KEY CONCEPTS TO COVER:** {', '.join(subtopic_data['key_concepts'])}
+    **TARGET DURATION:** {subtopic_data['estimated_duration']}
+    **PREVIOUS CONTEXT:** {previous_context}""")
+
+    return f"""
+    You are writing a detailed audiobook narration for "{book_title}".
+    Write a separate narration script for EACH of the {len(group)} subtopics below.
+    {''.join(sections)}
+
+    **YOUR TASK:**
+    For every subtopic, create an engaging, flowing narration that follows these critical style requirements:
+    1. **CONTINUOUS NARRATION:** Write as a single, continuous story. Start by smoothly transitioning from that subtopic's previous context.
+    2. **DEEP EXPLORATION:** Thoroughly explore each key concept with clear explanations, using direct quotes, examples, and analogies from the book.
+    3. **NO META-COMMENTARY:** Do NOT use phrases like "Welcome back," "In this segment," or "In the next part." The narration should be seamless.
+    4. **TONE:** Write like a thoughtful narrator exploring the book's ideas in depth, as if having an intimate conversation with the listener.
+    5. **FORMAT:** Each markdown_script starts with the markdown heading `## <subtitle>` and then the narration in natural, spoken-word paragraphs.
+
+    Output a JSON array with one {{"subtitle", "markdown_script"}} object per subtopic, in the order given.
+
+    {_book_text_block(book_text, "**BOOK TEXT FOR REFERENCE:**")}
+    """
+
+def parse_topic_scripts(response_text):
+    """Parses a grouped response, raising unless it is a JSON array (e.g. when it was cut off)."""
+    scripts = json.loads(response_text)
+    if not isinstance(scripts, list):
+        raise ValueError("expected a JSON array of subtopic scripts")
+    return scripts
+
+async def generate_topic_scripts(book_text, book_title, group, model):
+    """
+    Generates the scripts of a group of subtopics in a single structured-JSON request.
+    Returns one script (or None) per subtopic, in group order.
+    """
+    print(f"\nGenerating {len(group)} scripts in one request, starting with: '{group[0][0]['subtitle']}'...")
+    prompt = build_topic_prompt(book_text, book_title, group)
+    generation_config = genai.GenerationConfig(
+        response_mime_type='application/json',
+        response_schema=list[SubtopicScript],
+        max_output_tokens=MAX_OUTPUT_TOKENS,
+    )
+    try:
+        scripts = await cached_generate_async(model, prompt, generation_config, parse=parse_topic_scripts)
+    except Exception as e:
+        print(f"An error occurred during grouped script generation: {e}")
+        return [None] * len(group)
+
+    by_subtitle = {}
+    for item in scripts:
+        if isinstance(item, dict) and item.get('markdown_script'):
+            by_subtitle[item.get('subtitle', '').strip()] = item['markdown_script']
+    results = [by_subtitle.get(subtopic['subtitle'].strip()) for subtopic, _ in group]
+    # Fall back to positional matching if the model rephrased the subtitles
+    if not any(results) and len(scripts) == len(group):
+        results = [item.get('markdown_script') if isinstance(item, dict) else None for item in scripts]
+    return results
+
 # --- Phase 3: Process All Topics and Subtopics ---
-def generate_all_script_chunks(book_text, book_title, outline_data, model):
-    """Process all main topics and their subtopics to generate script chunks."""
-    all_chunks = []
-    
+def build_previous_contexts(book_title, subtopics):
+    """
+    The PREVIOUS CONTEXT hint for every subtopic, derived from the outline order alone
+    so the chunks can be generated concurrently and still transition in sequence.
+    """
     # Correctly initialize the context to be generic and book-specific
-    previous_context = f"We are beginning our journey into the core ideas of the book, '{book_title}'."
-    
+    contexts = [f"We are beginning our journey into the core ideas of the book, '{book_title}'."]
+    for subtopic in subtopics[:-1]:
+        contexts.append(f"Having just explored the concepts within '{subtopic['subtitle']}', we now transition to the next idea.")
+    return contexts
+
+async def generate_all_script_chunks(book_text, book_title, outline_data, model, use_batch=USE_BATCH_API, api_key=None,
+                                     cached_content=None):
+    """
+    Process all main topics and their subtopics to generate script chunks.
+    Subtopics are requested concurrently (MAX_CONCURRENT_REQUESTS in flight, paced by
+    GEMINI_LIMITER), MAX_SUBTOPICS_PER_REQUEST of a main topic per request with
+    GROUP_SUBTOPICS_BY_TOPIC, or, with
+    `use_batch`, submitted together as a single Batch API job; the chunks are returned
+    in outline order.
+    """
+    subtopics = []
     for main_topic in outline_data['main_topics']:
-        print(f"\n=== PROCESSING MAIN TOPIC: {main_topic['title']} ===")
-        
-        for subtopic in main_topic['subtopics']:
-            chunk = generate_detailed_script_chunk(book_text, book_title, subtopic, previous_context, model)
-            if chunk:
-                all_chunks.append(chunk)
-                print(f"✓ Generated script for: {subtopic['subtitle']}")
-                
-                # Update context for the next chunk
-                previous_context = f"Having just explored the concepts within '{subtopic['subtitle']}', we now transition to the next idea."
-            else:
-                print(f"✗ Failed to generate script for: {subtopic['subtitle']}")
-                return None  # Stop if any chunk fails
-            
-            time.sleep(3)  # API rate limiting
+        print(f"\n=== QUEUING MAIN TOPIC: {main_topic['title']} ===")
+        subtopics.extend(main_topic['subtopics'])
+
+    previous_contexts = build_previous_contexts(book_title, subtopics)
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def _generate(subtopic, previous_context):
+        async with sem, GEMINI_LIMITER:
+            return await generate_detailed_script_chunk(book_text, book_title, subtopic, previous_context, model)
+
+    if GROUP_SUBTOPICS_BY_TOPIC and not use_batch:
+        # Requests of up to MAX_SUBTOPICS_PER_REQUEST subtopics from the same main topic;
+        # the contexts still come from the flattened outline order
+        groups, start = [], 0
+        for main_topic in outline_data['main_topics']:
+            end = start + len(main_topic['subtopics'])
+            for group_start in range(start, end, MAX_SUBTOPICS_PER_REQUEST):
+                group_end = min(group_start + MAX_SUBTOPICS_PER_REQUEST, end)
+                groups.append(list(zip(subtopics[group_start:group_end], previous_contexts[group_start:group_end])))
+            start = end
+
+        async def _generate_group(group):
+            async with sem, GEMINI_LIMITER:
+                return await generate_topic_scripts(book_text, book_title, group, model)
+
+        group_results = await asyncio.gather(*(_generate_group(group) for group in groups))
+        results = [chunk for group_result in group_results for chunk in group_result]
+
+        # Subtopics missing from a grouped response get their own request
+        missing = [i for i, chunk in enumerate(results) if not chunk]
+        retried = await asyncio.gather(*(_generate(subtopics[i], previous_contexts[i]) for i in missing))
+        for i, chunk in zip(missing, retried):
+            results[i] = chunk
+    elif use_batch:
+        print(f"\n=== Generating {len(subtopics)} subtopic scripts as one batch job ===")
+        prompts = [
+            build_script_prompt(book_text, book_title, subtopic, context)
+            for subtopic, context in zip(subtopics, previous_contexts)
+        ]
+        # Only prompts without a cached response go into the batch job
+        results = [get_cached_response(prompt) for prompt in prompts]
+        uncached = [i for i, text in enumerate(results) if text is None]
+        if uncached:
+            batch_results = await run_batch_job(
+                api_key, MODEL_NAME, [prompts[i] for i in uncached], f'{book_title} subtopic scripts',
+                cached_content=cached_content
+            )
+            for i, text in zip(uncached, batch_results):
+                if text:
+                    store_cached_response(prompts[i], text)
+                results[i] = text
+    else:
+        results = await asyncio.gather(*(
+            _generate(subtopic, context) for subtopic, context in zip(subtopics, previous_contexts)
+        ))
+
+    all_chunks = []
+    for subtopic, chunk in zip(subtopics, results):
+        if chunk:
+            all_chunks.append(chunk)
+            print(f"✓ Generated script for: {subtopic['subtitle']}")
+        else:
+            print(f"✗ Failed to generate script for: {subtopic['subtitle']}")
+            return None  # Stop if any chunk fails
     
     return all_chunks
 
@@ -185,7 +402,7 @@ def save_chunks_to_files(script_chunks, book_title, author):
     return len(final_chunks)
 
 # --- MAIN EXECUTION ---
-if __name__ == "__main__":
+def main():
     # Pull settings from the central config file
     BOOK_TITLE = config.BOOK_TITLE
     AUTHOR = config.AUTHOR
@@ -195,36 +412,61 @@ if __name__ == "__main__":
 
     if not os.path.exists(book_file_path):
         print(f"Error: The file was not found at {book_file_path}")
-    else:
-        api_key = load_api_key()
-        if not api_key:
-            print("Could not load API key. Exiting.")
+        return
+
+    api_key = load_api_key('google')
+    if not api_key:
+        print("Could not load API key. Exiting.")
+        return
+
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel(MODEL_NAME)
+    
+    full_book_text = get_book_text(book_file_path) # Simplified from previous code
+    if not full_book_text:
+        print("❌ Failed to extract text from EPUB.")
+        return
+
+    set_response_cache_book(full_book_text)
+    # Upload the book once; the outline and every subtopic request reference the cache
+    book_cache = create_book_cache(full_book_text, MODEL_NAME, BOOK_TITLE.replace("_", " "))
+    prompt_book_text = full_book_text
+    if book_cache:
+        model = genai.GenerativeModel.from_cached_content(book_cache)
+        prompt_book_text = None
+
+    try:
+        # Generate detailed outline
+        outline_data = generate_detailed_outline(prompt_book_text, BOOK_TITLE.replace("_", " "), model)
+        if not outline_data:
+            print("❌ Failed to generate detailed outline.")
+            return
+
+        # Save outline for reference
+        outline_path = os.path.join(config.BOOK_DIR, 'detailed_outline.json')
+        os.makedirs(os.path.dirname(outline_path), exist_ok=True)
+        with open(outline_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(outline_data, indent=2))
+        print(f"Detailed outline saved to: {outline_path}")
+    
+        cached_content = book_cache.name if book_cache else None
+        if USE_BATCH_API and book_cache and not extend_book_cache(book_cache):
+            # The batch job could outlive the cache, so its prompts carry the book
+            prompt_book_text, cached_content = full_book_text, None
+
+        # Generate all script chunks
+        all_script_chunks = asyncio.run(generate_all_script_chunks(
+            prompt_book_text, BOOK_TITLE.replace("_", " "), outline_data, model,
+            api_key=api_key, cached_content=cached_content
+        ))
+    
+        if all_script_chunks:
+            total_chunks = save_chunks_to_files(all_script_chunks, BOOK_TITLE, AUTHOR)
+            print(f"\n🎉 SUCCESS! Generated {total_chunks} detailed script chunks.")
         else:
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel('gemini-2.0-flash') 
-            
-            full_book_text = get_book_text(book_file_path) # Simplified from previous code
-            if full_book_text:
-                # Generate detailed outline
-                outline_data = generate_detailed_outline(full_book_text, BOOK_TITLE.replace("_", " "), model)
-                
-                if outline_data:
-                    # Save outline for reference
-                    outline_path = os.path.join(config.BOOK_DIR, 'detailed_outline.json')
-                    os.makedirs(os.path.dirname(outline_path), exist_ok=True)
-                    with open(outline_path, 'w', encoding='utf-8') as f:
-                        json.dump(outline_data, f, indent=2)
-                    print(f"Detailed outline saved to: {outline_path}")
-                    
-                    # Generate all script chunks
-                    all_script_chunks = generate_all_script_chunks(full_book_text, BOOK_TITLE.replace("_", " "), outline_data, model)
-                    
-                    if all_script_chunks:
-                        total_chunks = save_chunks_to_files(all_script_chunks, BOOK_TITLE, AUTHOR)
-                        print(f"\n🎉 SUCCESS! Generated {total_chunks} detailed script chunks.")
-                    else:
-                        print("❌ Failed to generate all script chunks.")
-                else:
-                    print("❌ Failed to generate detailed outline.")
-            else:
-                print("❌ Failed to extract text from EPUB.")
\ No newline at end of file
+            print("❌ Failed to generate all script chunks.")
+    finally:
+        delete_book_cache(book_cache)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Helpers for finding and ordering the numbered asset files (chunk_NN.txt, audio_part_N.wav, ...)."""
+import os
+import re
+import functools
+from collections import defaultdict
+
+_DIGITS_RE = re.compile(r'\d+')
+
+CHUNK_FILE_RE = re.compile(r'chunk_\d+\.txt')
+IMAGE_FILE_RE = re.compile(r'image_part_(\d+)_img_(\d+)\.png')
+
+@functools.lru_cache(maxsize=4096)
+def part_sort_key(path):
+    """Returns the integers in a file's name as a tuple, e.g. 'image_part_2_img_10.png' -> (2, 10)."""
+    return tuple(int(n) for n in _DIGITS_RE.findall(os.path.basename(path)))
+
+def sorted_by_part(paths):
+    """Sorts numbered asset paths by their part/image numbers (so part 10 comes after part 9)."""
+    return sorted(paths, key=part_sort_key)
+
+def scan_files(directory, pattern=None):
+    """
+    Lists the (non-hidden) files in a directory with a single os.scandir,
+    optionally keeping only names that match `pattern`.
+    """
+    try:
+        with os.scandir(directory) as entries:
+            return [
+                e.path for e in entries
+                if not e.name.startswith('.') and e.is_file() and (pattern is None or pattern.fullmatch(e.name))
+            ]
+    except FileNotFoundError:
+        return []
+
+def group_images_by_part(images_dir):
+    """Scans the images directory once and buckets the image paths by part number."""
+    by_part = defaultdict(list)
+    for path in scan_files(images_dir, IMAGE_FILE_RE):
+        part_num = int(IMAGE_FILE_RE.fullmatch(os.path.basename(path)).group(1))
+        by_part[part_num].append(path)
+    return by_part
+
+def prefetch_files(paths):
+    """
+    Asks the OS to start reading `paths` into the page cache (posix_fadvise WILLNEED), so
+    later reads don't wait on the disk. A no-op on platforms without posix_fadvise.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
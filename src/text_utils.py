@@ -0,0 +1,173 @@
+"""Text and config helpers shared by the pipeline stages."""
+import os
+import re
+import glob
+import json
+import functools
+from concurrent.futures import ProcessPoolExecutor
+import config
+
+# lxml walks the HTML in C; BeautifulSoup is only used when lxml isn't installed
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+_NON_SPACE_RE = re.compile(r'\S')
+_WHITESPACE_RE = re.compile(r'\s+')
+# A ```json ... ``` fence wrapped around the whole model response (only at the very start/end)
+_CODE_FENCE_RE = re.compile(r'\A\s*```(?:json)?\s*|\s*```\s*\Z')
+
+@functools.lru_cache(maxsize=None)
+def load_api_key(service):
+    """
+    Loads the API key for `service` ('google' or 'elevenlabs'), preferring the
+    <SERVICE>_API_KEY environment variable over config/api_keys.json.
+    Cached, so each key is resolved once per process no matter which generator asks.
+    """
+    env_key = os.environ.get(f"{service.upper()}_API_KEY")
+    if env_key:
+        return env_key
+    try:
+        with open(os.path.join(config.CONFIG_DIR, 'api_keys.json'), 'r') as f:
+            keys = json.load(f)
+            return keys.get(f"{service}_api_key")
+    except Exception as e:
+        print(f"Error loading API key: {e}")
+        return None
+
+# Below this many documents, starting worker processes costs more than it saves
+PARALLEL_EXTRACT_MIN_ITEMS = 16
+
+def _extract_text(content):
+    """Returns the visible text of one EPUB document with whitespace collapsed to single spaces."""
+    if not content or content.isspace():
+        return ''  # lxml refuses to parse an empty document
+    if lxml is not None:
+        doc = lxml.html.fromstring(content)
+        # text_content() would include CSS, JS and the <title>; only the body text is wanted
+        for el in doc.xpath('//script|//style|//head'):
+            el.drop_tree()
+        text = doc.text_content()
+    else:
+        from bs4 import BeautifulSoup
+        # Pass the raw bytes so BeautifulSoup honours the document's declared encoding
+        soup = BeautifulSoup(content, 'html.parser')
+        for el in soup.find_all(['script', 'style', 'head']):
+            el.decompose()
+        text = soup.get_text()
+    return _WHITESPACE_RE.sub(' ', text).strip()
+
+def get_book_text(epub_path):
+    """
+    Opens an EPUB file and extracts all readable text content.
+    The extracted text is cached in config.BOOK_CACHE_DIR, keyed by the EPUB's name,
+    mtime and size, so re-runs skip the parse entirely until the book file changes.
+    """
+    try:
+        stat = os.stat(epub_path)
+    except FileNotFoundError:
+        print(f"Error: EPUB file not found at {epub_path}")
+        return None
+
+    cache_name = f"{os.path.basename(epub_path)}-{stat.st_mtime_ns}-{stat.st_size}.txt"
+    cache_path = os.path.join(config.BOOK_CACHE_DIR, cache_name)
+    if os.path.exists(cache_path):
+        print(f"Loading cached book text from: {cache_path}")
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    # Only the script generators read EPUBs; keep ebooklib out of the audio generators' imports
+    import ebooklib
+    from ebooklib import epub
+
+    print(f"Reading and parsing EPUB file from: {epub_path}")
+    try:
+        book = epub.read_epub(epub_path)
+        contents = [item.get_content() for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT)]
+        if len(contents) >= PARALLEL_EXTRACT_MIN_ITEMS:
+            # HTML parsing is CPU-bound, so fan the documents out across cores
+            with ProcessPoolExecutor() as ex:
+                texts = list(ex.map(_extract_text, contents, chunksize=4))
+        else:
+            texts = [_extract_text(content) for content in contents]
+        full_text = [text for text in texts if text]
+        print(f"Successfully extracted text from EPUB. Found {len(full_text)} content items.")
+        book_text = "\n\n".join(full_text)
+    except FileNotFoundError:
+        print(f"Error: EPUB file not found at {epub_path}")
+        return None
+    except Exception as e:
+        print(f"An error occurred while parsing the EPUB: {e}")
+        return None
+
+    try:
+        os.makedirs(config.BOOK_CACHE_DIR, exist_ok=True)
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            f.write(book_text)
+        # Entries for earlier versions of the same EPUB can never be hit again
+        entry_re = re.compile(re.escape(os.path.basename(epub_path)) + r'-\d+-\d+\.txt')
+        for stale_path in glob.glob(os.path.join(config.BOOK_CACHE_DIR, '*.txt')):
+            if stale_path != cache_path and entry_re.fullmatch(os.path.basename(stale_path)):
+                os.remove(stale_path)
+    except OSError as e:
+        print(f"Warning: Could not write book text cache: {e}")
+    return book_text
+
+def strip_code_fences(text):
+    """Removes a markdown code fence around an LLM response so it can be passed to json.loads."""
+    return _CODE_FENCE_RE.sub('', text)
+
+def read_master_script(book_title, script_filename):
+    """Reads the content of the master script file."""
+    script_path = os.path.join('..', 'books', book_title, 'scripts', script_filename)
+    try:
+        with open(script_path, 'r', encoding='utf-8') as f:
+            print(f"Successfully read master script from {script_path}")
+            return f.read()
+    except FileNotFoundError:
+        print(f"Error: Master script file not found at {script_path}")
+        return None
+
+def split_script(text, max_chars):
+    """
+    Splits the script into chunks under the character limit, breaking on paragraph
+    boundaries ('\\n\\n') wherever possible.
+
+    Paragraphs are packed greedily in a single forward pass that only tracks offsets
+    into `text`, so each chunk is sliced out exactly once. A paragraph that is longer
+    than `max_chars` on its own is hard-split.
+    """
+    chunks = []
+    text_len = len(text)
+    start = None  # offset where the chunk being built begins
+    end = 0       # offset where its last paragraph ends
+    pos = 0
+    while pos < text_len:
+        brk = text.find('\n\n', pos)
+        para_end = text_len if brk == -1 else brk
+        first_char = _NON_SPACE_RE.search(text, pos, para_end)
+        pos = para_end + 2
+        if not first_char:
+            continue  # blank paragraph
+
+        if start is not None and para_end - start > max_chars:
+            chunks.append(text[start:end].rstrip())
+            start = None
+        if start is None:
+            start = first_char.start()
+
+        while para_end - start > max_chars:
+            chunks.append(text[start:start + max_chars].rstrip())
+            first_char = _NON_SPACE_RE.search(text, start + max_chars, para_end)
+            start = first_char.start() if first_char else None
+            if start is None:
+                break
+        if start is not None:
+            end = para_end
+
+    if start is not None:
+        chunks.append(text[start:end].rstrip())
+
+    print(f"Script split into {len(chunks)} chunks for audio generation.")
+    return chunks
@@ -2,13 +2,122 @@ import os
 import subprocess
 import glob
 import random
-from natsort import natsorted
+import wave
+import threading
+import functools
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from path_utils import group_images_by_part, sorted_by_part
 import config  # Use our new central config file
 
 # All hardcoded paths have been removed. They are now accessed via the 'config' module.
 
+# Each software (libx264) encode is capped at FFMPEG_THREADS threads; together they shouldn't exceed the cores
+FFMPEG_THREADS = 2
+MAX_PARALLEL_ENCODES = max(1, (os.cpu_count() or 2) // FFMPEG_THREADS)
+# Shared by every encode in the process, however many pools are submitting work
+_encode_slots = threading.BoundedSemaphore(MAX_PARALLEL_ENCODES)
+# Parts processed at the same time; their encodes still go through _encode_slots
+MAX_PARALLEL_PARTS = max(1, (os.cpu_count() or 2) // 2)
+
+# Width images are upscaled to before zoompan. zoompan rounds its crop window to whole pixels,
+# so working above the 1920px output keeps slow zooms/pans from juddering; 2x output is enough
+# for the 1.1x maximum zoom without pushing ~36 MP frames through the filter like 8000px did.
+ZOOMPAN_PRESCALE_WIDTH = 3840
+
+# Short-lived per-image clips, placeholders and concat lists go to RAM (tmpfs) when there is room
+SCRATCH_ROOT = '/dev/shm'
+SCRATCH_MIN_FREE_BYTES = 2 * 1024 ** 3
+
+def make_scratch_dir():
+    """
+    Returns (path, is_tmpfs): a fresh directory under SCRATCH_ROOT for intermediates that are
+    deleted right after use, or config.TEMP_DIR on disk when tmpfs is missing or nearly full.
+    """
+    try:
+        if shutil.disk_usage(SCRATCH_ROOT).free >= SCRATCH_MIN_FREE_BYTES:
+            return tempfile.mkdtemp(prefix='video_assembler_', dir=SCRATCH_ROOT), True
+    except OSError:
+        pass
+    return config.TEMP_DIR, False
+
+def run_encode(cmd):
+    """Runs an ffmpeg encode once one of the MAX_PARALLEL_ENCODES slots is free (subprocess releases the GIL)."""
+    with _encode_slots:
+        return subprocess.run(cmd, capture_output=True, text=True)
+
+# Hardware H.264 encoders to try, best first; libx264 on the CPU is the fallback
+HW_ENCODERS = ('h264_nvenc', 'h264_vaapi')
+VAAPI_DEVICE = '/dev/dri/renderD128'
+
+@functools.lru_cache(maxsize=None)
+def detect_video_encoder():
+    """
+    Returns the H.264 encoder to use, checked once per run: the first of HW_ENCODERS
+    that ffmpeg lists AND that survives a tiny test encode (a listed encoder may still
+    lack a usable GPU/driver), otherwise 'libx264'.
+    """
+    try:
+        listed = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True).stdout
+    except OSError:
+        return 'libx264'
+    for encoder in HW_ENCODERS:
+        if encoder not in listed:
+            continue
+        test_cmd = ['ffmpeg', '-hide_banner', '-f', 'lavfi', '-i', 'color=black:s=256x256:d=0.1']
+        test_cmd += video_codec_args(encoder) + ['-f', 'null', '-']
+        if encoder == 'h264_vaapi':
+            test_cmd[-3:-3] = ['-vf', hw_upload_filter(encoder).lstrip(',')]
+        if subprocess.run(test_cmd, capture_output=True, text=True).returncode == 0:
+            print(f"Using hardware encoder: {encoder}")
+            return encoder
+    return 'libx264'
+
+# Every encoded segment/clip gets the same GOP, profile/level and track timescale, so the clips
+# and segments can always be joined with the concat demuxer and `-c copy`. The pixel format
+# (yuv420p, or nv12 on VAAPI) is fixed per encoder by video_codec_args()/hw_upload_filter().
+MP4_TIMESCALE_OPTS = ['-video_track_timescale', '15360']
+COMMON_ENC_OPTS = [
+    '-g', '48', '-keyint_min', '48', '-sc_threshold', '0',
+    '-profile:v', 'high', '-level', '4.0',
+    *MP4_TIMESCALE_OPTS,
+]
+
+# Quality targets for the slideshow encodes. The segments are stream-copied into the final
+# video, so these set its quality too; a slow-moving slideshow still looks clean at these values.
+X264_CRF = 28
+NVENC_CQ = 30
+
+def video_codec_args(encoder=None):
+    """ffmpeg output options for the chosen H.264 encoder."""
+    encoder = encoder or detect_video_encoder()
+    if encoder == 'h264_nvenc':
+        return ['-c:v', 'h264_nvenc', '-preset', 'p1', '-rc', 'vbr', '-cq', str(NVENC_CQ), '-pix_fmt', 'yuv420p']
+    if encoder == 'h264_vaapi':
+        # Frames are uploaded to the GPU by hw_upload_filter(), which fixes the pixel format
+        return ['-vaapi_device', VAAPI_DEVICE, '-c:v', 'h264_vaapi']
+    return [
+        '-c:v', 'libx264', '-threads', str(FFMPEG_THREADS), '-preset', 'veryfast',
+        '-tune', 'stillimage', '-crf', str(X264_CRF), '-pix_fmt', 'yuv420p'
+    ]
+
+def hw_upload_filter(encoder=None):
+    """Suffix for the video filter chain: VAAPI needs the frames uploaded to the GPU, the others nothing."""
+    encoder = encoder or detect_video_encoder()
+    return ',format=nv12,hwupload' if encoder == 'h264_vaapi' else ''
+
 def get_audio_duration(audio_file_path):
-    """Gets the duration of an audio file in seconds using ffprobe."""
+    """
+    Gets the duration of an audio file in seconds. WAV durations come straight from the
+    header via the standard `wave` module; ffprobe is only spawned for anything it can't read.
+    """
+    try:
+        with wave.open(audio_file_path, 'rb') as wav:
+            return wav.getnframes() / wav.getframerate()
+    except (wave.Error, EOFError, OSError):
+        pass
+
     command = [
         'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
         '-of', 'default=noprint_wrappers=1:nokey=1', audio_file_path
@@ -20,17 +129,24 @@ def get_audio_duration(audio_file_path):
         print(f"[ERROR] Could not get duration for {os.path.basename(audio_file_path)}: {e}")
         return None
 
-def create_placeholder_image(width=1920, height=1080, text=""):
-    """Creates a simple placeholder image if no images are available for a part."""
-    from PIL import Image, ImageDraw, ImageFont
-    
-    img = Image.new('RGB', (width, height), color='#1a1a1a')
-    draw = ImageDraw.Draw(img)
-    
+@functools.lru_cache(maxsize=None)
+def _placeholder_template(width, height):
+    """Loads the placeholder font and renders the blank background once per size; callers copy the image."""
+    from PIL import Image, ImageFont
+
     try:
         font = ImageFont.truetype("arial.ttf", 60)
-    except:
+    except OSError:
         font = ImageFont.load_default()
+    return Image.new('RGB', (width, height), color='#1a1a1a'), font
+
+def create_placeholder_image(width=1920, height=1080, text=""):
+    """Creates a simple placeholder image if no images are available for a part."""
+    from PIL import ImageDraw
+
+    background, font = _placeholder_template(width, height)
+    img = background.copy()
+    draw = ImageDraw.Draw(img)
     
     # Use the book title from the config file, replacing underscores with spaces
     display_text = text if text else config.BOOK_TITLE.replace("_", " ")
@@ -43,16 +159,21 @@ def create_placeholder_image(width=1920, height=1080, text=""):
     
     return img
 
-def create_animated_slideshow(images, total_duration, output_path, part_number):
+def create_animated_slideshow(images, total_duration, output_path, part_number, audio_path=None, overlay_path=None, scratch_dir=None):
     """
     Creates a smooth, full-duration animated slideshow by prescaling images
-    and using duration-aware animation logic.
+    and using duration-aware animation logic. The whole slideshow is rendered in
+    one ffmpeg filtergraph; per-image clips plus a concat are only the fallback.
+    With `audio_path` (and optionally `overlay_path`) the narration and overlay are
+    mixed into the same pass, so `output_path` is the finished segment.
+    Intermediate files are written to `scratch_dir` (default config.TEMP_DIR).
     """
-    print(f"Step 1/2: Creating animated slideshow for part {part_number}...")
+    print(f"Creating animated slideshow for part {part_number}...")
+    scratch_dir = scratch_dir or config.TEMP_DIR
 
     if not images:
         print(f"[WARNING] No images found for part {part_number}. Creating placeholder...")
-        temp_placeholder = os.path.join(config.TEMP_DIR, f"placeholder_{part_number}.png")
+        temp_placeholder = os.path.join(scratch_dir, f"placeholder_{part_number}.png")
         create_placeholder_image(text=f"Part {part_number}").save(temp_placeholder)
         images = [temp_placeholder]
 
@@ -65,25 +186,62 @@ def create_animated_slideshow(images, total_duration, output_path, part_number):
         print(f"[ERROR] Cannot create animation with zero or negative duration for part {part_number}.")
         return False
 
-    base_filter_chain = "scale=w='if(gt(a,16/9),-1,1920)':h='if(gt(a,16/9),1080,-1)',crop=1920:1080,scale=8000:-1"
+    base_filter_chain = f"scale=w='if(gt(a,16/9),-1,1920)':h='if(gt(a,16/9),1080,-1)',crop=1920:1080,scale={ZOOMPAN_PRESCALE_WIDTH}:-1"
     
     animation_presets = {
-        'smooth_zoom_in':  f"zoompan=z='lerp(1,1.1,on/{duration_in_frames})':d={duration_in_frames}:x='iw/2-(iw/zoom/2)':y='ih/2-(ih/zoom/2)':s=1920x1080:fps=24",
-        'smooth_zoom_out': f"zoompan=z='lerp(1.1,1,on/{duration_in_frames})':d={duration_in_frames}:x='iw/2-(iw/zoom/2)':y='ih/2-(ih/zoom/2)':s=1920x1080:fps=24",
+        'smooth_zoom_in':  f"zoompan=z='lerp(1,1.1,on/{duration_in_frames})':d={duration_in_frames}:x='(iw-iw/zoom)/2':y='(ih-ih/zoom)/2':s=1920x1080:fps=24",
+        'smooth_zoom_out': f"zoompan=z='lerp(1.1,1,on/{duration_in_frames})':d={duration_in_frames}:x='(iw-iw/zoom)/2':y='(ih-ih/zoom)/2':s=1920x1080:fps=24",
         'pan_right':       f"zoompan=z=1.1:d={duration_in_frames}:x='(iw-iw/zoom)*on/{duration_in_frames}':y='(ih-ih/zoom)/2':s=1920x1080:fps=24",
         'pan_left':        f"zoompan=z=1.1:d={duration_in_frames}:x='(iw-iw/zoom)*(1-on/{duration_in_frames})':y='(ih-ih/zoom)/2':s=1920x1080:fps=24",
     }
     preset_keys = list(animation_presets.keys())
-    
-    temp_clips = []
+
+    # Preferred path: one ffmpeg process animates every image and concatenates them in a single
+    # filtergraph, so there is one encode and no intermediate clip files. zoompan emits d frames
+    # per input frame, so a single (non-looped) image input yields exactly one clip's worth.
+    valid_images = [(i, image_path) for i, image_path in enumerate(images) if os.path.exists(image_path)]
     for i, image_path in enumerate(images):
-        temp_clip_path = os.path.join(config.TEMP_DIR, f"temp_clip_{part_number}_{i}.mp4")
+        if not os.path.exists(image_path):
+            print(f"[WARNING] Image not found, skipping: {image_path}")
+    if not valid_images:
+        print("[ERROR] No video clips were created successfully for this part.")
+        return False
+
+    cmd = ['ffmpeg', '-y']
+    filters = []
+    for n, (i, image_path) in enumerate(valid_images):
+        cmd += ['-i', image_path]
+        effect_key = preset_keys[i % len(preset_keys)]
+        filters.append(f"[{n}:v]{base_filter_chain},{animation_presets[effect_key]},setsar=1[v{n}]")
+    concat_inputs = ''.join(f"[v{n}]" for n in range(len(valid_images)))
+    next_input = len(valid_images)
+    if overlay_path:
+        cmd += ['-stream_loop', '-1', '-i', overlay_path]
+        filters.append(f"{concat_inputs}concat=n={len(valid_images)}:v=1:a=0[slides]")
+        filters.append(f"[{next_input}:v]colorkey=black:0.3:0.2[ckout]")
+        filters.append(f"[slides][ckout]overlay{hw_upload_filter()}[out]")
+        next_input += 1
+    else:
+        filters.append(f"{concat_inputs}concat=n={len(valid_images)}:v=1:a=0{hw_upload_filter()}[out]")
+    audio_args = []
+    if audio_path:
+        cmd += ['-i', audio_path]
+        audio_args = ['-map', f'{next_input}:a', '-c:a', 'aac', '-b:a', '192k', '-shortest']
+    cmd += ['-filter_complex', ';'.join(filters), '-map', '[out]', *video_codec_args(), *COMMON_ENC_OPTS, *audio_args, output_path]
+
+    overlay_name = os.path.basename(overlay_path) if overlay_path else 'None'
+    print(f"  > Animating {len(valid_images)} images in a single pass (audio: {'yes' if audio_path else 'no'}, overlay: '{overlay_name}')...")
+    result = run_encode(cmd)
+    if result.returncode == 0:
+        return True
+    print(f"[WARNING] Single-pass slideshow failed for part {part_number}, falling back to per-image clips:\n{result.stderr}")
+    
+    def _animate(i, image_path):
+        temp_clip_path = os.path.join(scratch_dir, f"temp_clip_{part_number}_{i}.mp4")
         
         if not os.path.exists(image_path):
             print(f"[WARNING] Image not found, skipping: {image_path}")
-            continue
-            
-        temp_clips.append(temp_clip_path)
+            return None
         
         effect_key = preset_keys[i % len(preset_keys)]
         animation_filter = animation_presets[effect_key]
@@ -92,30 +250,40 @@ def create_animated_slideshow(images, total_duration, output_path, part_number):
         
         cmd = [
             'ffmpeg', '-y', '-loop', '1', '-i', image_path,
-            '-vf', f"{base_filter_chain},{animation_filter}",
-            '-c:v', 'libx264', '-t', str(image_duration), '-pix_fmt', 'yuv420p',
+            '-vf', f"{base_filter_chain},{animation_filter}{hw_upload_filter()}",
+            *video_codec_args(), *COMMON_ENC_OPTS, '-t', str(image_duration),
             temp_clip_path
         ]
         
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        result = run_encode(cmd)
         if result.returncode != 0:
             print(f"[ERROR] FFmpeg failed for image {i+1}:\n{result.stderr}")
-            if temp_clip_path in temp_clips: temp_clips.remove(temp_clip_path)
+            return None
+        return temp_clip_path
+
+    # The images are independent, so encode them concurrently; map() keeps the clips in image order
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_ENCODES) as ex:
+        temp_clips = [clip for clip in ex.map(_animate, range(len(images)), images) if clip]
 
     existing_clips = [clip for clip in temp_clips if os.path.exists(clip)]
     if not existing_clips:
         print("[ERROR] No video clips were created successfully for this part.")
         return False
 
+    # Without audio the concatenated clips are the result; with it they are an intermediate
+    slideshow_path = output_path
+    if audio_path:
+        slideshow_path = os.path.join(scratch_dir, f'slideshow_{part_number}.mp4')
+
     print(f"  > Stitching {len(existing_clips)} animated clips together...")
-    concat_list_path = os.path.join(config.TEMP_DIR, f'animated_clips_{part_number}.txt')
+    concat_list_path = os.path.join(scratch_dir, f'animated_clips_{part_number}.txt')
     with open(concat_list_path, 'w') as f:
         for clip_path in existing_clips:
             f.write(f"file '{os.path.abspath(clip_path)}'\n")
 
     cmd_concat = [
         'ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', concat_list_path,
-        '-c', 'copy', output_path
+        '-c', 'copy', slideshow_path
     ]
     result = subprocess.run(cmd_concat, capture_output=True, text=True)
     if result.returncode != 0:
@@ -125,6 +293,89 @@ def create_animated_slideshow(images, total_duration, output_path, part_number):
     for clip in existing_clips: os.remove(clip)
     os.remove(concat_list_path)
 
+    if audio_path:
+        muxed = mux_audio_and_overlay(slideshow_path, audio_path, overlay_path, output_path, part_number)
+        os.remove(slideshow_path)
+        return muxed
+    return True
+
+def mux_audio_and_overlay(slideshow_path, audio_path, overlay_path, output_path, part_number):
+    """Adds the narration and the (optional) overlay to an already rendered slideshow."""
+    overlay_name = os.path.basename(overlay_path) if overlay_path else 'None'
+    print(f"  > Adding audio and overlay ('{overlay_name}') to part {part_number}...")
+
+    if overlay_path:
+        filter_complex_str = f"[1:v]colorkey=black:0.3:0.2[ckout];[0:v][ckout]overlay{hw_upload_filter()}[v]"
+        ffmpeg_overlay_cmd = [
+            'ffmpeg', '-y', '-i', slideshow_path, '-stream_loop', '-1', '-i', overlay_path, '-i', audio_path,
+            '-filter_complex', filter_complex_str, '-map', '[v]', '-map', '2:a',
+            *video_codec_args(), *COMMON_ENC_OPTS, '-c:a', 'aac', '-b:a', '192k', '-shortest', output_path
+        ]
+    else:
+        ffmpeg_overlay_cmd = [
+            'ffmpeg', '-y', '-i', slideshow_path, '-i', audio_path,
+            '-c:v', 'copy', *MP4_TIMESCALE_OPTS, '-c:a', 'aac', '-b:a', '192k', '-shortest', output_path
+        ]
+    
+    result = run_encode(ffmpeg_overlay_cmd)
+    if result.returncode != 0:
+        print(f"[ERROR] FFmpeg failed for part {part_number}:\n{result.stderr}")
+        return False
+    return True
+
+def normalize_overlay(overlay_path, temp_dir):
+    """
+    Re-encodes one overlay to a plain yuv420p H.264 file without audio, so the parts that use
+    it all decode the same cheap stream. The normalized file is named after the source's name,
+    mtime and size, so it is only reused for exactly that file.
+    Returns the path to use for the overlay (the original one if the encode fails).
+    """
+    stat = os.stat(overlay_path)
+    name = os.path.splitext(os.path.basename(overlay_path))[0]
+    normalized_path = os.path.join(temp_dir, f'overlay_norm_{name}-{stat.st_mtime_ns}-{stat.st_size}.mp4')
+    if os.path.exists(normalized_path):
+        return normalized_path
+
+    print(f"  > Normalizing overlay '{os.path.basename(overlay_path)}'...")
+    cmd = [
+        'ffmpeg', '-y', '-i', overlay_path,
+        '-c:v', 'libx264', '-threads', str(FFMPEG_THREADS), '-crf', '18', '-pix_fmt', 'yuv420p', '-an',
+        '-f', 'mp4', f'{normalized_path}.part'
+    ]
+    result = run_encode(cmd)
+    if result.returncode != 0:
+        print(f"[WARNING] Could not normalize overlay '{os.path.basename(overlay_path)}', using it as is:\n{result.stderr}")
+        return overlay_path
+    # Only a complete encode gets the name that marks it as reusable
+    os.replace(f'{normalized_path}.part', normalized_path)
+    return normalized_path
+
+def process_part(audio_path, images, overlay_path, temp_dir, total_parts, scratch_dir=None):
+    """Builds the slideshow for one audio part and muxes in its audio and overlay. Returns True on success."""
+    part_num_str = os.path.basename(audio_path).replace('audio_part_', '').replace('.wav', '')
+    print(f"\n--- Processing Part {part_num_str}/{total_parts} ---")
+
+    images = sorted_by_part(images)
+    if not images:
+        print(f"Warning: No images found for part {part_num_str}. Will create placeholder.")
+    else:
+        print(f"Found {len(images)} images for part {part_num_str}.")
+    
+    duration = get_audio_duration(audio_path)
+    if not duration:
+        print(f"Skipping part {part_num_str} due to audio duration error.")
+        return False
+    
+    print(f"Audio duration: {duration:.2f} seconds")
+    
+    # Slideshow, narration and overlay are rendered together straight into the segment
+    processed_segment_path = os.path.join(temp_dir, f'processed_segment_{part_num_str}.mp4')
+    if not create_animated_slideshow(images, duration, processed_segment_path, part_num_str,
+                                     audio_path=audio_path, overlay_path=overlay_path, scratch_dir=scratch_dir):
+        print(f"Failed to create segment for part {part_num_str}. Skipping.")
+        return False
+    
+    print(f"-> Part {part_num_str} complete!")
     return True
 
 def process_all_parts():
@@ -132,8 +383,8 @@ def process_all_parts():
     temp_dir = os.path.join(config.VIDEO_DIR, 'temp_files')
     os.makedirs(temp_dir, exist_ok=True)
     
-    audio_files = natsorted(glob.glob(os.path.join(config.AUDIO_DIR, 'audio_part_*.wav')))
-    overlay_files = glob.glob(os.path.join(config.OVERLAYS_DIR, '*.*'))
+    audio_files = sorted_by_part(glob.glob(os.path.join(config.AUDIO_DIR, 'audio_part_*.wav')))
+    overlay_files = sorted(glob.glob(os.path.join(config.OVERLAYS_DIR, '*.*')))
 
     if not audio_files:
         print(f"Error: No audio files found in {config.AUDIO_DIR}")
@@ -143,67 +394,51 @@ def process_all_parts():
     print(f"🎵 Found {len(audio_files)} audio files to process.")
     print(f"📁 Book: {config.BOOK_TITLE}")
     print(f"🎬 Creating video with {len(audio_files)} segments...")
-    
-    successful_parts = 0
 
-    for i, audio_path in enumerate(audio_files):
-        part_num_str = os.path.basename(audio_path).replace('audio_part_', '').replace('.wav', '')
-        print(f"\n--- Processing Part {part_num_str}/{len(audio_files)} ---")
+    # One scan of the images directory instead of a glob over it for every part
+    images_by_part = group_images_by_part(config.IMAGES_DIR)
+    part_images = [
+        images_by_part.get(int(os.path.basename(audio_path).replace('audio_part_', '').replace('.wav', '')), [])
+        for audio_path in audio_files
+    ]
 
-        images = natsorted(glob.glob(os.path.join(config.IMAGES_DIR, f'image_part_{part_num_str}_img_*.png')))
-        if not images:
-            print(f"Warning: No images found for part {part_num_str}. Will create placeholder.")
-        else:
-            print(f"Found {len(images)} images for part {part_num_str}.")
-        
-        duration = get_audio_duration(audio_path)
-        if not duration:
-            print(f"Skipping part {part_num_str} due to audio duration error.")
-            continue
-        
-        print(f"Audio duration: {duration:.2f} seconds")
-        
-        slideshow_path = os.path.join(temp_dir, f'slideshow_{part_num_str}.mp4')
-        if not create_animated_slideshow(images, duration, slideshow_path, part_num_str):
-            print(f"Failed to create slideshow for part {part_num_str}. Skipping.")
-            continue
+    detect_video_encoder()  # Probe once here rather than racing in every worker
 
-        processed_segment_path = os.path.join(temp_dir, f'processed_segment_{part_num_str}.mp4')
-        overlay_path = random.choice(overlay_files) if overlay_files else None
-        
-        overlay_name = os.path.basename(overlay_path) if overlay_path else 'None'
-        print(f"Step 2/2: Adding audio and overlay ('{overlay_name}') to part {part_num_str}...")
-
-        if overlay_path:
-            filter_complex_str = "[1:v]colorkey=black:0.3:0.2[ckout];[0:v][ckout]overlay[v]"
-            ffmpeg_overlay_cmd = [
-                'ffmpeg', '-y', '-i', slideshow_path, '-stream_loop', '-1', '-i', overlay_path, '-i', audio_path,
-                '-filter_complex', filter_complex_str, '-map', '[v]', '-map', '2:a',
-                '-c:v', 'libx264', '-c:a', 'aac', '-b:a', '192k', '-shortest', processed_segment_path
-            ]
-        else:
-            ffmpeg_overlay_cmd = [
-                'ffmpeg', '-y', '-i', slideshow_path, '-i', audio_path,
-                '-c:v', 'copy', '-c:a', 'aac', '-b:a', '192k', '-shortest', processed_segment_path
-            ]
-        
-        result = subprocess.run(ffmpeg_overlay_cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            print(f"[ERROR] FFmpeg failed for part {part_num_str}:\n{result.stderr}")
-            continue
-        
-        successful_parts += 1
-        print(f"-> Part {part_num_str} complete! ({successful_parts}/{len(audio_files)} total)")
+    # Each distinct overlay is decoded/normalized once up front instead of once per part using it
+    if overlay_files:
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_ENCODES) as ex:
+            overlay_files = list(ex.map(normalize_overlay, overlay_files, [temp_dir] * len(overlay_files)))
+    # Overlays are dealt out round-robin by part order: every overlay gets an even share and a
+    # re-run of the same book always gives the same assignment
+    overlays = [overlay_files[i % len(overlay_files)] if overlay_files else None for i in range(len(audio_files))]
+
+    scratch_dir, scratch_is_tmpfs = make_scratch_dir()
+    try:
+        # Parts are independent until the final concat; all their encodes share the _encode_slots limit
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_PARTS) as ex:
+            results = list(ex.map(
+                process_part, audio_files, part_images, overlays, [temp_dir] * len(audio_files),
+                [len(audio_files)] * len(audio_files), [scratch_dir] * len(audio_files)
+            ))
+    finally:
+        if scratch_is_tmpfs:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+    successful_parts = sum(results)
         
     print(f"\n--- Processing Summary ---")
     print(f"Successfully processed: {successful_parts}/{len(audio_files)} parts")
     return successful_parts > 0
 
 def concatenate_final_video():
-    """Stitches all processed segments into the final video."""
+    """
+    Stitches all processed segments into the final video.
+    This is a pure stream copy, which is only safe because every segment was encoded with
+    COMMON_ENC_OPTS (same GOP, profile/level, pixel format and timescale); any new encode
+    step that writes a segment must use them too.
+    """
     print("\n--- Assembling Final Video ---")
     temp_dir = os.path.join(config.VIDEO_DIR, 'temp_files')
-    processed_segments = natsorted(glob.glob(os.path.join(temp_dir, 'processed_segment_*.mp4')))
+    processed_segments = sorted_by_part(glob.glob(os.path.join(temp_dir, 'processed_segment_*.mp4')))
     
     if not processed_segments:
         print("No processed segments to assemble. Halting.")
@@ -219,7 +454,7 @@ def concatenate_final_video():
     final_video_path = os.path.join(config.VIDEO_DIR, f"{config.BOOK_TITLE}_final_video.mp4")
     os.makedirs(config.VIDEO_DIR, exist_ok=True)
     
-    ffmpeg_concat_cmd = ['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', concat_list_path, '-c', 'copy', final_video_path]
+    ffmpeg_concat_cmd = ['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', concat_list_path, '-c', 'copy', '-movflags', '+faststart', final_video_path]
     
     result = subprocess.run(ffmpeg_concat_cmd, capture_output=True, text=True)
     if result.returncode != 0:
@@ -257,7 +492,7 @@ def add_narration_and_music(video_with_narration_path):
     cmd_mix_audio = [
         'ffmpeg', '-y', '-i', video_with_narration_path, '-stream_loop', '-1', '-i', music_path,
         '-filter_complex', filter_complex_str, '-map', '0:v', '-map', '[final_audio]',
-        '-c:v', 'copy', '-c:a', 'aac', '-b:a', '192k', '-shortest', final_video_path
+        '-c:v', 'copy', '-c:a', 'aac', '-b:a', '192k', '-shortest', '-movflags', '+faststart', final_video_path
     ]
     
     print("Executing FFmpeg command to mix audio...")
@@ -269,7 +504,7 @@ def add_narration_and_music(video_with_narration_path):
     print(f"Success! Final video with music and narration saved to: {final_video_path}")
 
 
-if __name__ == "__main__":
+def main():
     print(f"=== Video Assembly for '{config.BOOK_TITLE}' ===")
     
     if process_all_parts():
@@ -277,4 +512,7 @@ if __name__ == "__main__":
         if video_with_narration:
             add_narration_and_music(video_with_narration)
     else:
-        print("\nVideo assembly failed. No parts were processed successfully. Please check the errors above.")
\ No newline at end of file
+        print("\nVideo assembly failed. No parts were processed successfully. Please check the errors above.")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file